@@ -1,19 +1,76 @@
-import numpy as np
+import math
 import time
 import socket
 import json
+import struct
 import logging
 import asyncio
 from datetime import datetime
 from fmpy import read_model_description, extract
 from fmpy.fmi2 import FMU2Slave
 import threading
-from typing import Dict, Any, Optional
+from collections import deque, namedtuple
+from typing import Dict, Any, Optional, List, Tuple
+
+try:
+    import msgspec
+except ImportError:  # Không có msgspec thì dùng JSON
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:  # Chế độ JSON dùng json chuẩn
+    orjson = None
+
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:  # numba là tùy chọn, fallback sang struct.pack_into
+    njit = None
 
 # logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("FMUCANBridge")
 
+# Header độ dài (uint32 big-endian) đứng trước mỗi payload msgpack
+_LENGTH_PREFIX = struct.Struct('>I')
+
+# Một mẫu dữ liệu FMU mỗi bước (immutable, không cần copy)
+FmuSample = namedtuple('FmuSample', 'ambient headlamp tailLamp brakeLamp vehicle_speed '
+                                    'light_level timestamp simulation_time')
+
+# Layout CAN 0x100: flags, light_level, speed, ambient (uint16), 3 byte reserved
+_CAN_STRUCT = struct.Struct('>BBBH3x')
+
+def _json_default(obj):
+    """Chuyển CAN payload nhị phân thành list int cho chế độ JSON"""
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return list(obj)
+    return str(obj)
+
+def _json_dumps(data: Dict[str, Any]) -> bytes:
+    """JSON newline-delimited bằng json chuẩn (fallback khi không có orjson)"""
+    return (json.dumps(data, default=_json_default) + '\n').encode('utf-8')
+
+def _orjson_dumps(data: Dict[str, Any]) -> bytes:
+    """JSON newline-delimited bằng orjson, trả về bytes trực tiếp"""
+    return orjson.dumps(data, default=_json_default, option=orjson.OPT_APPEND_NEWLINE)
+
+if njit is not None:
+    @njit(cache=True)
+    def _pack_light_control(flags, light_level, speed, ambient, out):
+        """Ghi CAN 0x100 vào mảng uint8[8] (cùng layout với _CAN_STRUCT)"""
+        out[0] = flags & 0xFF
+        out[1] = min(255, max(0, light_level))
+        out[2] = min(255, max(0, speed))
+        out[3] = (ambient >> 8) & 0xFF
+        out[4] = ambient & 0xFF
+        out[5] = 0
+        out[6] = 0
+        out[7] = 0
+else:
+    _pack_light_control = None
+
 
 class FMUSimulator:
     """Lớp mô phỏng FMU autoLamp (dựa trên code của bạn)"""
@@ -30,11 +87,7 @@ class FMUSimulator:
         self.running = False
         
         # Giá trị hiện tại
-        self.current_values = {
-            'ambient': 0.0,
-            'headlamp': False,
-            'timestamp': 0.0
-        }
+        self.current_values = FmuSample(0.0, False, False, False, 0.0, 0, 0.0, 0.0)
         
     def load(self):
         """Tải FMU"""
@@ -88,41 +141,56 @@ class FMUSimulator:
         
         self.fmu.exitInitializationMode()
         
+        # Resolve value reference một lần, tránh quét modelVariables mỗi bước
+        headlamp_names = ['headlamp', 'headLamp', 'head_lamp', 'HeadLamp', 'highBeam']
+        vr_by_name = {}
+        self._vr_headlamp = None
+        for var in self.md.modelVariables:
+            vr_by_name[var.name] = var.valueReference
+            if self._vr_headlamp is None and any(name in var.name.lower() for name in headlamp_names):
+                self._vr_headlamp = var.valueReference
+        
+        # Đặt input ambient_light (giả sử vr=0 nếu không tìm thấy)
+        self._vr_ambient = vr_by_name.get('ambient_light') or 0
+        if self._vr_headlamp is None:
+            raise RuntimeError("Headlamp output not found in FMU")
+        logger.info(f"Value references: ambient_light={self._vr_ambient}, headlamp={self._vr_headlamp}")
+        
+        # List dùng lại cho setReal/getBoolean, không cấp phát mới mỗi bước
+        self._ambient_vr_buf = [self._vr_ambient]
+        self._ambient_val_buf = [0.0]
+        self._headlamp_vr_buf = [self._vr_headlamp]
+        
         logger.info("FMU setup completed")
     
-    def run_step(self) -> Dict[str, Any]:
+    def run_step(self) -> FmuSample:
         """Chạy một bước mô phỏng"""
         if not self.fmu:
             raise RuntimeError("FMU not initialized")
         
         # Tạo tín hiệu ambient (giữ nguyên logic của bạn)
-        ambient = 250 + 100 * np.sin(self.t)
+        # math.sin trên float, tránh overhead tạo mảng 0-d của numpy mỗi bước
+        sin_t = math.sin(self.t)
+        ambient = 250 + 100 * sin_t
         
-        # Đặt input ambient_light (giả sử vr=0 cho ambient)
-        # Bạn cần kiểm tra value reference thực tế từ FMU
-        ambient_vr = self.get_variable_reference('ambient_light') or 0
-        self.fmu.setReal([ambient_vr], [ambient])
+        # Đặt input ambient_light (vr đã resolve trong setup)
+        self._ambient_val_buf[0] = ambient
+        self.fmu.setReal(self._ambient_vr_buf, self._ambient_val_buf)
         
         # Thực hiện bước mô phỏng
         self.fmu.doStep(self.t, self.dt)
         
-        # Lấy output headlamp (giả sử vr=0 cho headlamp boolean)
-        # headlamp_vr = self.get_variable_reference('headlamp') or 0
-        headlamp_names = ['headlamp', 'headLamp', 'head_lamp', 'HeadLamp', 'highBeam']
-        for var in self.md.modelVariables:
-                if any(name in var.name.lower() for name in headlamp_names):
-                    self.headlamp_vr = var.valueReference
-                    break
-        headlamp = self.fmu.getBoolean([self.headlamp_vr])[0]
+        # Lấy output headlamp
+        headlamp = self.fmu.getBoolean(self._headlamp_vr_buf)[0]
         # try:
-        #     headlamp_bool = self.fmu.getBoolean([self.headlamp_vr])[0]  # Thử boolean
+        #     headlamp_bool = self.fmu.getBoolean([self._vr_headlamp])[0]  # Thử boolean
         # except:
         #     try:
-        #         headlamp_real = self.fmu.getReal([self.headlamp_vr])[0]  # Thử real
+        #         headlamp_real = self.fmu.getReal([self._vr_headlamp])[0]  # Thử real
         #         headlamp_bool = headlamp_real > 0.5  # Convert
         #     except:
         #         try:
-        #             headlamp_int = self.fmu.getInteger([self.headlamp_vr])[0]  # Thử integer
+        #             headlamp_int = self.fmu.getInteger([self._vr_headlamp])[0]  # Thử integer
         #             headlamp_bool = bool(headlamp_int)
         #         except:
         #             headlamp_bool = False  # Mặc định
@@ -131,27 +199,27 @@ class FMUSimulator:
         # taillamp = self.fmu.getBoolean([tail_lamp_vr])[0] if tail_lamp_vr != 1 else False
         
         # Cập nhật trạng thái
-        self.current_values = {
-            'ambient': ambient,
-            'headlamp': headlamp,
-            'tailLamp': False,  # Giả định, thay bằng biến thực tế nếu có
-            'brakeLamp': False, # Giả định
-            'vehicle_speed': 50 + 10 * np.sin(self.t),  # Mô phỏng
-            'light_level': int((ambient / 400) * 100),  # Chuyển thành %
-            'timestamp': time.time(),
-            'simulation_time': self.t
-        }
+        self.current_values = FmuSample(
+            ambient=ambient,
+            headlamp=headlamp,
+            tailLamp=False,  # Giả định, thay bằng biến thực tế nếu có
+            brakeLamp=False, # Giả định
+            vehicle_speed=50 + 10 * sin_t,  # Mô phỏng
+            light_level=int((ambient / 400) * 100),  # Chuyển thành %
+            timestamp=time.time(),
+            simulation_time=self.t
+        )
         
         # Tăng thời gian
         self.t += self.dt
 
         # logger.debug(f"FMU Step: t={self.t}, ambient={ambient}, headlamp={headlamp}")
         
-        return self.current_values.copy()
+        return self.current_values
     
-    def get_current_values(self) -> Dict[str, Any]:
+    def get_current_values(self) -> FmuSample:
         """Lấy giá trị hiện tại"""
-        return self.current_values.copy()
+        return self.current_values
     
     def cleanup(self):
         """Dọn dẹp tài nguyên"""
@@ -185,136 +253,295 @@ class CANMessageEncoder:
             import yaml
             with open(config_path, 'r') as f:
                 self.config.update(yaml.safe_load(f))
+        
+        # Tính trước (vị trí field trong FmuSample, mask) cho các tín hiệu boolean
+        # của byte cờ; tín hiệu FMU không cung cấp (indicator) luôn là 0
+        self._bool_masks: List[Tuple[int, int]] = [
+            (FmuSample._fields.index(name), 1 << cfg['bit'])
+            for name, cfg in self.config['light_control']['signals'].items()
+            if cfg.get('type') == 'bool' and cfg['byte'] == 0 and name in FmuSample._fields
+        ]
+        self._buf = bytearray(_CAN_STRUCT.size)
+        self._view = memoryview(self._buf)
+        
+        # Kernel numba nếu có; gọi thử một lần để JIT trước khi vào vòng lặp
+        self._out = None
+        if _pack_light_control is not None:
+            self._out = np.zeros(_CAN_STRUCT.size, dtype=np.uint8)
+            self._view = memoryview(self._out)
+            _pack_light_control(0, 0, 0, 0, self._out)
     
-    def encode(self, fmu_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Mã hóa dữ liệu FMU thành CAN frame"""
+    def new_frame(self) -> Dict[str, Any]:
+        """Tạo dict CAN frame để dùng lại với encode_into()"""
         config = self.config['light_control']
+        return {
+            'can_id': config['id'],
+            'can_data': self._view,
+            'dlc': config['dlc'],
+            'timestamp': None,
+            'sim_time': 0.0,
+            'source': 'autoLamp_fmu'
+        }
+    
+    def encode(self, fmu_data: FmuSample) -> Dict[str, Any]:
+        """Mã hóa dữ liệu FMU thành CAN frame
         
+        can_data là memoryview trên buffer dùng lại của encoder, chỉ hợp lệ
+        đến lần gọi encode() tiếp theo.
+        """
+        return self.encode_into(fmu_data, self.new_frame())
+    
+    def encode_into(self, fmu_data: FmuSample, frame: Dict[str, Any]) -> Dict[str, Any]:
+        """Mã hóa dữ liệu FMU vào frame có sẵn (từ new_frame()), không tạo dict mới"""
         # logger.debug(f"Encoding FMU data: {fmu_data}")
 
-        # Tạo data buffer 8 bytes
-        data = bytearray(8)
-        
         # Đặt các tín hiệu boolean
-        for signal_name, signal_config in config['signals'].items():
-            if signal_name in fmu_data and signal_config.get('type') == 'bool':
-                byte_pos = signal_config['byte']
-                bit_pos = signal_config['bit']
-                
-                if fmu_data[signal_name]:
-                    data[byte_pos] |= (1 << bit_pos)
-        
-        # Đặt light_level
-        if 'light_level' in fmu_data:
-            light_val = int(fmu_data['light_level'])
-            light_val = max(0, min(255, light_val))
-            data[1] = light_val
-        
-        # Đặt vehicle_speed
-        if 'vehicle_speed' in fmu_data:
-            speed_val = int(fmu_data['vehicle_speed'])
-            speed_val = max(0, min(255, speed_val))
-            data[2] = speed_val
-        
-        # Thêm ambient vào byte 3-4 (dạng uint16)
-        if 'ambient' in fmu_data:
-            ambient_val = int(fmu_data['ambient'])
-            data[3] = (ambient_val >> 8) & 0xFF  # High byte
-            data[4] = ambient_val & 0xFF         # Low byte
+        flags = 0
+        for idx, mask in self._bool_masks:
+            flags |= mask if fmu_data[idx] else 0
+        
+        light_val = int(fmu_data.light_level)
+        speed_val = int(fmu_data.vehicle_speed)
+        
+        # Ambient vào byte 3-4 (uint16 big-endian), kẹp về 0-65535 thay vì cắt bit
+        ambient_val = max(0, min(0xFFFF, int(fmu_data.ambient)))
+        
+        if self._out is not None:
+            _pack_light_control(flags, light_val, speed_val, ambient_val, self._out)
+        else:
+            # light_level, vehicle_speed kẹp về 0-255
+            _CAN_STRUCT.pack_into(self._buf, 0, flags, min(255, max(0, light_val)),
+                                  min(255, max(0, speed_val)), ambient_val)
 
-        logger.debug(f"Encoded CAN frame: ID=0x{config['id']:X}, Data: {list(data)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Encoded CAN frame: ID=0x%X, Data: %s", frame['can_id'], list(self._view))
         
-        return {
-            'can_id': config['id'],
-            'can_data': list(data),
-            'dlc': config['dlc'],
-            'timestamp': fmu_data.get('timestamp', time.time()),
-            'sim_time': fmu_data.get('simulation_time', 0),
-            'source': 'autoLamp_fmu'
-        }
+        frame['timestamp'] = fmu_data.timestamp
+        frame['sim_time'] = fmu_data.simulation_time
+        return frame
 
 class WSL2SocketBridge:
     """Bridge kết nối Windows với WSL2 qua socket"""
     
-    def __init__(self, host: str = "localhost", port: int = 8888):
+    def __init__(self, host: str = "localhost", port: int = 8888, use_json: bool = False):
         self.host = host
         self.port = port
         self.socket = None
         self.connected = False
         self.reconnect_attempts = 0
-        self.max_reconnect_attempts = 5
+        self.max_reconnect_attempts = 10
+        self._next_reconnect_ns = 0
+        self._connect_future = None
+        
+        # msgpack (length-prefixed) là mặc định, JSON chỉ để debug
+        if not use_json and msgspec is None:
+            logger.warning("msgspec not installed, falling back to JSON")
+        self.use_json = use_json or msgspec is None
+        self._encoder = None if self.use_json else msgspec.msgpack.Encoder()
+        self._dumps = _json_dumps if orjson is None else _orjson_dumps
+        self._send_buf = bytearray(64)
+        
+        # I/O chạy trên event loop riêng, vòng lặp mô phỏng chỉ đẩy frame vào queue
+        self._queue = deque(maxlen=1024)
+        self._loop = None
+        self._loop_thread = None
+        self._writer = None
+        self._writer_task = None
+        self._event = None
+    
+    def _ensure_loop(self):
+        """Khởi động event loop I/O trong thread riêng (một lần)"""
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(target=self._loop.run_forever,
+                                                 name="WSL2SocketBridgeIO", daemon=True)
+            self._loop_thread.start()
         
     def connect(self) -> bool:
         """Kết nối đến WSL2 socket server"""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(5.0)
-            self.socket.connect((self.host, self.port))
+            self._ensure_loop()
+            future = asyncio.run_coroutine_threadsafe(self._open_connection(), self._loop)
+            try:
+                future.result(timeout=5.0)
+            except Exception:
+                future.cancel()
+                raise
             self.connected = True
             self.reconnect_attempts = 0
             logger.info(f"Connected to WSL2 at {self.host}:{self.port}")
             return True
         except Exception as e:
-            logger.error(f"Connection failed: {e}")
+            logger.error(f"Connection failed: {e!r}")
             self.connected = False
             return False
     
+    async def _open_connection(self):
+        """Mở StreamWriter và khởi động writer task (chạy trên loop I/O)"""
+        await self._close_writer()
+        _, self._writer = await asyncio.open_connection(self.host, self.port)
+        self.socket = self._writer.get_extra_info('socket')
+        self.tune_socket()
+        self._event = asyncio.Event()
+        # Frame còn sót từ kết nối cũ đã lỗi thời, kết nối mới chỉ gửi trạng thái mới nhất
+        self._queue.clear()
+        self._writer_task = asyncio.get_running_loop().create_task(self._writer_loop())
+    
+    async def _writer_loop(self):
+        """Gửi các frame trong queue xuống socket, gom tất cả frame đang chờ mỗi lần"""
+        queue = self._queue
+        writer = self._writer
+        try:
+            while True:
+                await self._event.wait()
+                self._event.clear()
+                while queue:
+                    writer.writelines([queue.popleft() for _ in range(len(queue))])
+                    await writer.drain()
+        except asyncio.CancelledError:
+            raise
+        except ConnectionError as e:
+            logger.error(f"Connection error: {e}")
+        except Exception as e:
+            logger.error(f"Send error: {e}")
+        finally:
+            self.connected = False
+    
+    async def _drain(self):
+        """Ghi nốt các frame còn trong queue và chờ gửi xong"""
+        queue = self._queue
+        while queue:
+            self._writer.writelines([queue.popleft() for _ in range(len(queue))])
+        await self._writer.drain()
+    
+    async def _close_writer(self):
+        """Hủy writer task và đóng StreamWriter hiện tại"""
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+            self._writer = None
+    
+    def tune_socket(self):
+        """Tắt Nagle và tăng send buffer cho các frame nhỏ, gửi thường xuyên"""
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64 * 1024)
+        # TCP_QUICKACK chỉ có trên Linux
+        if hasattr(socket, 'TCP_QUICKACK'):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    
     def reconnect(self) -> bool:
-        """Thử kết nối lại"""
+        """Thử kết nối lại với backoff lũy thừa (10ms → 1s), không block vòng lặp mô phỏng"""
+        future = self._connect_future
+        if future is not None:
+            if not future.done():
+                return True  # Đang kết nối
+            self._connect_future = None
+            error = future.exception()
+            if error is None:
+                self.connected = True
+                self.reconnect_attempts = 0
+                logger.info(f"Reconnected to WSL2 at {self.host}:{self.port}")
+                return True
+            logger.error(f"Reconnect failed: {error!r}")
+        
         if self.reconnect_attempts >= self.max_reconnect_attempts:
             logger.error("Max reconnection attempts reached")
             return False
         
+        now_ns = time.monotonic_ns()
+        if now_ns < self._next_reconnect_ns:
+            return True
+        
+        delay = min(2 ** self.reconnect_attempts * 0.01, 1.0)
         self.reconnect_attempts += 1
+        self._next_reconnect_ns = now_ns + int(delay * 1e9)
         logger.info(f"Reconnecting attempt {self.reconnect_attempts}...")
-        time.sleep(1)
-        return self.connect()
+        # open_connection dùng socket non-blocking + selector, chỉ lên lịch và trả về ngay
+        self._ensure_loop()
+        self._connect_future = asyncio.run_coroutine_threadsafe(self._open_connection(), self._loop)
+        return True
     
     def send_data(self, data: Dict[str, Any]) -> bool:
-        """Gửi dữ liệu đến WSL2"""
-        if not self.connected or not self.socket:
-            if not self.reconnect():
+        """Đưa dữ liệu vào queue gửi đến WSL2 (không block vòng lặp mô phỏng)"""
+        if not self.connected:
+            # Mất kết nối: bỏ frame (như trước đây), chỉ lên lịch reconnect.
+            # Frame chỉ vào queue khi đã có kết nối, nên không gửi dồn frame cũ
+            self.reconnect()
+            if not self.connected:
                 return False
         
         try:
-            # Chuyển thành JSON và thêm newline delimiter
-            json_data = json.dumps(data, default=str)
-            message = json_data + '\n'
-            # logger.debug(f"Sending to WSL2: {data}")
-            self.socket.sendall(message.encode('utf-8'))
-            return True
-            
-        except socket.timeout:
-            logger.warning("Socket timeout")
-            self.connected = False
+            if self.use_json:
+                # Chuyển thành JSON và thêm newline delimiter
+                message = self._dumps(data)
+            else:
+                # msgpack ghi thẳng vào buffer dùng lại, sau 4 byte độ dài
+                buf = self._send_buf
+                self._encoder.encode_into(data, buf, _LENGTH_PREFIX.size)
+                _LENGTH_PREFIX.pack_into(buf, 0, len(buf) - _LENGTH_PREFIX.size)
+                message = bytes(buf)
+        except Exception as e:
+            logger.error(f"Encode error: {e}")
             return False
-        except ConnectionError as e:
-            logger.error(f"Connection error: {e}")
-            self.connected = False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending to WSL2: %s", data)
+        
+        # Queue đầy thì frame cũ nhất bị bỏ (deque maxlen)
+        self._queue.append(message)
+        event = self._event
+        if not event.is_set():
+            self._loop.call_soon_threadsafe(event.set)
+        return True
+    
+    def flush(self, timeout: float = 2.0) -> bool:
+        """Chờ gửi hết các frame còn trong queue"""
+        if not self.connected or self._writer is None:
             return False
+        try:
+            asyncio.run_coroutine_threadsafe(self._drain(), self._loop).result(timeout)
+            return True
         except Exception as e:
-            logger.error(f"Send error: {e}")
+            logger.error(f"Flush error: {e!r}")
             return False
     
     def close(self):
         """Đóng kết nối"""
-        if self.socket:
-            self.socket.close()
+        if self._loop is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self._close_writer(), self._loop).result(2.0)
+            except Exception as e:
+                logger.debug(f"Close error: {e!r}")
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join(timeout=2.0)
+            if not self._loop_thread.is_alive():
+                self._loop.close()
+            self._loop = None
+            self._loop_thread = None
+        self.socket = None
         self.connected = False
         logger.info("Socket connection closed")
 
 class FMUCANBridge:
     """Bridge chính: FMU → CAN encoding → WSL2"""
     
-    def __init__(self, fmu_path: str, wsl_host: str = "localhost", wsl_port: int = 8888):
+    def __init__(self, fmu_path: str, wsl_host: str = "localhost", wsl_port: int = 8888,
+                 use_json: bool = False):
         self.fmu_sim = FMUSimulator(fmu_path)
         self.encoder = CANMessageEncoder()
-        self.socket_bridge = WSL2SocketBridge(wsl_host, wsl_port)
+        self.socket_bridge = WSL2SocketBridge(wsl_host, wsl_port, use_json)
         
         self.running = False
         self.cycle_time = 0.1  # 100ms
         self.sent_messages = 0
         self.failed_messages = 0
+        self._log_every = 16  # Lũy thừa của 2 để kiểm tra bằng bitmask
+        self._frame = self.encoder.new_frame()  # Frame dùng lại mỗi chu kỳ
         
         # Statistics
         self.stats = {
@@ -338,39 +565,43 @@ class FMUCANBridge:
         
         logger.info("FMU CAN Bridge initialized")
     
+    def _tick(self) -> Tuple[FmuSample, bool]:
+        """Một chu kỳ: bước FMU → mã hóa vào frame dùng lại → đưa vào queue gửi"""
+        fmu_data = self.fmu_sim.run_step()
+        return fmu_data, self.socket_bridge.send_data(self.encoder.encode_into(fmu_data, self._frame))
+    
     def run_simulation(self, duration: float = 30.0):
         """Chạy mô phỏng trong thời gian xác định"""
         logger.info(f"Starting simulation for {duration} seconds...")
         
         self.running = True
-        start_time = time.time()
+        # Lập lịch theo deadline monotonic để không trôi theo đồng hồ hệ thống
+        cycle_ns = int(self.cycle_time * 1e9)
+        start_ns = time.monotonic_ns()
+        end_ns = start_ns + int(duration * 1e9)
+        step = 0
         
         try:
-            while time.time() - start_time < duration and self.running:
-                # Chạy một bước FMU
-                fmu_data = self.fmu_sim.run_step()
-                
-                # Mã hóa thành CAN frame
-                can_frame = self.encoder.encode(fmu_data)
-                
-                # Gửi qua socket đến WSL2
-                if self.socket_bridge.send_data(can_frame):
+            while time.monotonic_ns() < end_ns and self.running:
+                # Chạy một bước FMU, mã hóa và gửi qua socket đến WSL2
+                fmu_data, sent = self._tick()
+                if sent:
                     self.stats['messages_sent'] += 1
                     self.stats['last_sent'] = time.time()
                     
                     # Log thỉnh thoảng
-                    if self.stats['messages_sent'] % 10 == 0:
-                        headlamp_status = "ON" if fmu_data['headlamp'] else "OFF"
-                        logger.info(f"Sent: headLamp={headlamp_status}, "
-                                  f"ambient={fmu_data['ambient']:.1f}, "
-                                  f"total={self.stats['messages_sent']}")
+                    if ((self.stats['messages_sent'] & (self._log_every - 1)) == 0
+                            and logger.isEnabledFor(logging.INFO)):
+                        logger.info("Sent: headLamp=%s, ambient=%.1f, total=%d",
+                                    "ON" if fmu_data.headlamp else "OFF",
+                                    fmu_data.ambient, self.stats['messages_sent'])
                 else:
                     self.stats['messages_failed'] += 1
                 
-                # Đợi đến chu kỳ tiếp theo
-                elapsed = time.time() - (start_time + self.fmu_sim.t)
-                sleep_time = max(0, self.cycle_time - elapsed)
-                time.sleep(sleep_time)
+                # Đợi đến deadline của chu kỳ tiếp theo
+                step += 1
+                next_deadline_ns = start_ns + step * cycle_ns
+                time.sleep(max(0, (next_deadline_ns - time.monotonic_ns()) / 1e9))
                 
         except KeyboardInterrupt:
             logger.info("Simulation interrupted by user")
@@ -384,41 +615,36 @@ class FMUCANBridge:
         logger.info("Starting continuous simulation...")
         
         self.running = True
-        last_stats_time = time.time()
+        cycle_ns = int(self.cycle_time * 1e9)
+        start_ns = time.monotonic_ns()
+        last_stats_ns = start_ns
+        step = 0
         
         try:
             while self.running:
-                # Chạy một bước FMU
-                fmu_data = self.fmu_sim.run_step()
-                
-                # Mã hóa thành CAN frame
-                can_frame = self.encoder.encode(fmu_data)
-                
-                # Gửi qua socket
-                if self.socket_bridge.send_data(can_frame):
+                # Chạy một bước FMU, mã hóa và gửi qua socket
+                fmu_data, sent = self._tick()
+                if sent:
                     self.stats['messages_sent'] += 1
                     
                     # Hiển thị thống kê mỗi 5 giây
-                    current_time = time.time()
-                    if current_time - last_stats_time >= 5:
-                        elapsed = current_time - self.stats['start_time']
-                        rate = self.stats['messages_sent'] / elapsed if elapsed > 0 else 0
+                    now_ns = time.monotonic_ns()
+                    if now_ns - last_stats_ns >= 5_000_000_000:
+                        if logger.isEnabledFor(logging.INFO):
+                            elapsed = time.time() - self.stats['start_time']
+                            rate = self.stats['messages_sent'] / elapsed if elapsed > 0 else 0
+                            logger.info("Rate: %.1f msg/sec, Total: %d, HeadLamp: %s, Ambient: %.1f",
+                                        rate, self.stats['messages_sent'],
+                                        "ON" if fmu_data.headlamp else "OFF", fmu_data.ambient)
                         
-                        headlamp_status = "ON" if fmu_data['headlamp'] else "OFF"
-                        logger.info(f"Rate: {rate:.1f} msg/sec, "
-                                  f"Total: {self.stats['messages_sent']}, "
-                                  f"HeadLamp: {headlamp_status}, "
-                                  f"Ambient: {fmu_data['ambient']:.1f}")
-                        
-                        last_stats_time = current_time
+                        last_stats_ns = now_ns
                 else:
                     self.stats['messages_failed'] += 1
                 
                 # Điều chỉnh sleep time để giữ đúng tốc độ mô phỏng
-                target_time = self.fmu_sim.t / self.fmu_sim.dt * self.cycle_time
-                actual_time = time.time() - self.stats['start_time']
-                sleep_time = max(0, target_time - actual_time)
-                time.sleep(sleep_time)
+                step += 1
+                next_deadline_ns = start_ns + step * cycle_ns
+                time.sleep(max(0, (next_deadline_ns - time.monotonic_ns()) / 1e9))
                 
         except KeyboardInterrupt:
             logger.info("Simulation stopped by user")
@@ -431,6 +657,8 @@ class FMUCANBridge:
         """Dừng hệ thống"""
         self.running = False
         self.fmu_sim.cleanup()
+        if self.socket_bridge.connected:
+            self.socket_bridge.flush()
         self.socket_bridge.close()
         
         # Hiển thị thống kê cuối
@@ -453,10 +681,21 @@ class KuksaCANBridge:
         self.fmu_sim = FMUSimulator(fmu_path)
         self.encoder = CANMessageEncoder()
         
+        # Chỉ 2 tín hiệu thay đổi theo từng bước
+        self._kuksa_keys = ('Vehicle.Body.Lights.AmbientLight', 'Vehicle.Body.Lights.IsHighBeamOn')
+        # Giá trị mặc định, chỉ gửi một lần khi kết nối
+        self._static_values = {
+            "Vehicle.Body.Lighting.Threshold": 300.0,
+            "Vehicle.Body.Lighting.Hysteresis": 50.0,
+            "Vehicle.Body.Lighting.Power": 0.0,
+        }
+        self._datapoint = None
+        
     async def run_with_kuksa(self, kuksa_host: str = "localhost", kuksa_port: int = 55555):
         """Chạy với Kuksa VSS integration"""
         from kuksa_client.grpc import Datapoint
         from kuksa_client.grpc.aio import VSSClient
+        self._datapoint = Datapoint
         
         # Khởi tạo FMU
         self.fmu_sim.load()
@@ -467,6 +706,10 @@ class KuksaCANBridge:
             async with VSSClient(host=kuksa_host, port=kuksa_port) as client:
                 logger.info(f"Connected to Kuksa VSS at {kuksa_host}:{kuksa_port}")
                 
+                await client.set_current_values({
+                    key: Datapoint(value=value) for key, value in self._static_values.items()
+                })
+                
                 while True:
                     # Chạy một bước FMU
                     fmu_data = self.fmu_sim.run_step()
@@ -486,27 +729,30 @@ class KuksaCANBridge:
         finally:
             self.fmu_sim.cleanup()
     
-    async def send_to_kuksa(self, client, fmu_data: Dict[str, Any]):
+    async def send_to_kuksa(self, client, fmu_data: FmuSample):
         """Gửi dữ liệu đến Kuksa VSS"""
         try:
-            sample_data = {
-                "Vehicle.Body.Lights.AmbientLight": float(fmu_data.get('ambient', 0)),
-                "Vehicle.Body.Lighting.Threshold": 300.0,  # Giá trị mặc định
-                "Vehicle.Body.Lighting.Hysteresis": 50.0,   # Giá trị mặc định
-                "Vehicle.Body.Lights.IsHighBeamOn": bool(fmu_data.get('headlamp', False)),
-                "Vehicle.Body.Lighting.Power": 0.0  # Giá trị mặc định
-            }
-            
-            data_to_send = {}
-            for key, value in sample_data.items():
-                data_to_send[key] = Datapoint(value=value)
-            
-            await client.set_current_values(data_to_send)
-            # logger.debug(f"Sent to Kuksa: headlamp={sample_data['Vehicle.Body.Lights.IsHighBeamOn']}")
+            ambient_key, high_beam_key = self._kuksa_keys
+            datapoint = self._datapoint
+            await client.set_current_values({
+                ambient_key: datapoint(value=float(fmu_data.ambient)),
+                high_beam_key: datapoint(value=bool(fmu_data.headlamp)),
+            })
+            # logger.debug(f"Sent to Kuksa: headlamp={fmu_data.headlamp}")
             
         except Exception as e:
             logger.error(f"Failed to send to Kuksa: {e}")
 
+def install_uvloop() -> bool:
+    """Dùng uvloop làm event loop policy nếu đã cài (không hỗ trợ Windows)"""
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using uvloop event loop")
+    return True
+
 def main():
     """Hàm chính với CLI interface"""
     import argparse
@@ -528,12 +774,17 @@ def main():
                        help='Kuksa VSS port')
     parser.add_argument('--cycle-time', type=float, default=0.1,
                        help='Cycle time in seconds')
+    parser.add_argument('--json', action='store_true',
+                       help='Send newline-delimited JSON instead of msgpack (debug)')
     
     args = parser.parse_args()
     
+    # Áp dụng cho asyncio.run (Kuksa) và loop I/O của WSL2SocketBridge
+    install_uvloop()
+    
     if args.mode == 'can':
         # Chạy với CAN bridge
-        bridge = FMUCANBridge(args.fmu, args.wsl_host, args.wsl_port)
+        bridge = FMUCANBridge(args.fmu, args.wsl_host, args.wsl_port, args.json)
         bridge.cycle_time = args.cycle_time
         bridge.initialize()
         bridge.run_simulation(args.duration)
@@ -546,7 +797,7 @@ def main():
     elif args.mode == 'both':
         # Chạy cả hai (cần xử lý async)
         async def run_both():
-            can_bridge = FMUCANBridge(args.fmu, args.wsl_host, args.wsl_port)
+            can_bridge = FMUCANBridge(args.fmu, args.wsl_host, args.wsl_port, args.json)
             can_bridge.initialize()
             
             kuksa_bridge = KuksaCANBridge(args.fmu)
@@ -1,10 +1,28 @@
+import os
 import sys
 import json
 import time
+import socket
+import select
+import struct
+import logging
 import threading
-import queue
+from array import array
+from collections import deque
 import can  # Thêm thư viện python-can
 
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("ZonalControllerCAN")
+
+# struct can_frame của SocketCAN: can_id (u32), can_dlc (u8), 3 byte pad, data[8]
+_CAN_FRAME = struct.Struct('=IB3x8s')
+_CAN_EFF_FLAG = 0x80000000  # Bit extended ID trong can_id
+_CAN_RTR_FLAG = 0x40000000  # Bit remote frame trong can_id
+_CAN_EFF_MASK = 0x1FFFFFFF
+
+_BACKOFF_MIN = 0.01  # Backoff khi thread gặp lỗi: 10ms, nhân đôi tới 1s
+_BACKOFF_MAX = 1.0
+
 class ZonalControllerCAN:
     def __init__(self, zone_id, can_interface='vcan0'):
         self.zone_id = zone_id
@@ -13,11 +31,52 @@ class ZonalControllerCAN:
         # Khởi tạo CAN bus
         self.can_interface = can_interface
         self.can_bus = None
+        self.can_socket = None  # Raw PF_CAN socket cho RX/TX, None thì dùng python-can
+        self.rx_batch_size = 32  # Số frame tối đa lấy ra mỗi lần đọc bus
+        self._rx_frame_buf = bytearray(_CAN_FRAME.size)
         self.init_can_bus()
         
-        # Queue để lưu các CAN message
-        self.can_rx_queue = queue.Queue()
-        self.can_tx_queue = queue.Queue()
+        # Frame nhận được lưu theo cột (SoA): can_id thô kèm cờ EFF/RTR và payload bytes,
+        # không tạo object cho từng frame. RX thread ghi vào bộ cột hiện tại, processor
+        # đổi sang bộ dự phòng dưới lock rồi xử lý cả loạt.
+        self._rx_lock = threading.Lock()
+        self._rx_cols = (array('I'), [])
+        self._rx_spare = (array('I'), [])
+        self.rx_capacity = 8192  # Đầy thì bỏ frame mới và đếm vào rx_dropped
+        self.rx_dropped = 0
+        
+        # TX: can_frame đã pack (raw socket) hoặc can.Message; deque append/popleft là
+        # atomic (một producer/một consumer), không cần lock; đầy thì frame cũ nhất bị bỏ
+        self.can_tx_queue = deque(maxlen=8192)
+        self._tx_event = threading.Event()
+        self._rx_event = threading.Event()
+        self.status_period = 0.01  # Chu kỳ gửi zone status (10ms)
+        
+        # Zone status frame dựng sẵn một lần; mỗi chu kỳ chỉ ghi lại byte thời gian
+        # rồi đẩy chính object đó vào TX queue
+        status_id = 0x500 + self.zone_id
+        status_data = bytes((self.zone_id & 0xFF, 0x01, 0))
+        if self.can_socket is not None:
+            self._status_msg = bytearray(_CAN_FRAME.pack(status_id, len(status_data), status_data))
+            self._status_buf = memoryview(self._status_msg)[8:8 + len(status_data)]
+        else:
+            self._status_msg = can.Message(arbitration_id=status_id, data=status_data,
+                                           is_extended_id=False)
+            self._status_buf = self._status_msg.data
+        
+        # Realtime cho RX thread và zone processor: SCHED_FIFO + ghim mỗi thread một core
+        # riêng (None = tự chọn 2 core cuối trong affinity của process)
+        self.rt_priority = 50
+        self.rx_core = None
+        self.processor_core = None
+        
+        # Bảng handler theo CAN ID chuẩn (11 bit), dựng một lần thay cho chuỗi if/elif
+        self._handlers = [self._ignore_message] * 0x800
+        self._handlers[0x100] = self.handle_system_status          # System status message
+        for can_id in range(0x200, 0x300):
+            self._handlers[can_id] = self.handle_sensor_data      # Sensor data messages
+        for can_id in range(0x300, 0x400):
+            self._handlers[can_id] = self.handle_actuator_command  # Actuator control messages
         
         # Dữ liệu zone
         self.zone_data = {
@@ -32,10 +91,25 @@ class ZonalControllerCAN:
         self.can_tx_thread = threading.Thread(target=self.can_transmitter_thread, daemon=True)
         self.zone_processor_thread = threading.Thread(target=self.zone_processor, daemon=True)
         
+        # Đếm frame để chỉ log thỉnh thoảng (mỗi 256 frame)
+        self._rx_count = 0
+        self._tx_count = 0
+        self._log_mask = 0xFF
+        
         print(f"Zonal Controller {zone_id} đang khởi động với CAN interface: {can_interface}")
     
     def init_can_bus(self):
         """Khởi tạo kết nối CAN bus"""
+        # Ưu tiên raw PF_CAN socket: RX/TX đọc ghi thẳng struct can_frame, bỏ qua can.Message
+        try:
+            self.can_socket = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+            self.can_socket.bind((self.can_interface,))
+            print(f"Đã kết nối thành công đến CAN bus: {self.can_interface} (raw socket)")
+            return
+        except (AttributeError, OSError) as e:
+            logger.warning("Raw CAN socket không khả dụng (%s), dùng python-can", e)
+            self.can_socket = None
+        
         try:
             self.can_bus = can.interface.Bus(
                 channel=self.can_interface,
@@ -46,70 +120,151 @@ class ZonalControllerCAN:
             print(f"Lỗi khi khởi tạo CAN bus: {e}")
             sys.exit(1)
     
+    def _pick_cores(self):
+        """Chọn core cho RX thread và zone processor (khác nhau nếu có thể)"""
+        try:
+            cores = sorted(os.sched_getaffinity(0))
+        except AttributeError:  # Không phải Linux
+            return None, None
+        rx_core = self.rx_core if self.rx_core is not None else cores[-1]
+        processor_core = self.processor_core
+        if processor_core is None:
+            others = [core for core in cores if core != rx_core]
+            processor_core = others[-1] if others else rx_core
+        return rx_core, processor_core
+    
+    def _set_realtime(self, thread, core, name):
+        """Ghim thread vào một core và đặt SCHED_FIFO (best-effort, cần CAP_SYS_NICE)"""
+        tid = thread.native_id
+        if tid is None or core is None:
+            return
+        try:
+            os.sched_setaffinity(tid, {core})
+        except (AttributeError, OSError) as e:
+            logger.warning("Không ghim được %s vào CPU %d: %s", name, core, e)
+        try:
+            os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(self.rt_priority))
+        except PermissionError:
+            logger.warning("Không đủ quyền đặt SCHED_FIFO cho %s, giữ scheduler mặc định", name)
+        except (AttributeError, OSError) as e:
+            logger.warning("Không đặt được SCHED_FIFO cho %s: %s", name, e)
+        else:
+            logger.info("%s chạy SCHED_FIFO priority %d trên CPU %d", name, self.rt_priority, core)
+    
+    def _receive_raw_batch(self, timeout, ids, payloads):
+        """Chờ frame trên raw socket rồi lấy hết các frame đang chờ (tối đa rx_batch_size)"""
+        sock = self.can_socket
+        if not select.select([sock], [], [], timeout)[0]:
+            return
+        
+        buf = self._rx_frame_buf
+        for _ in range(self.rx_batch_size):
+            try:
+                sock.recv_into(buf, _CAN_FRAME.size, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            can_id, dlc, data = _CAN_FRAME.unpack_from(buf)
+            ids.append(can_id)
+            payloads.append(data[:dlc])
+    
+    def _receive_bus_batch(self, timeout, ids, payloads):
+        """Chờ frame qua python-can rồi lấy hết các frame đang chờ (tối đa rx_batch_size)"""
+        message = self.can_bus.recv(timeout=timeout)
+        while message is not None:
+            can_id = message.arbitration_id
+            if message.is_extended_id:
+                can_id |= _CAN_EFF_FLAG
+            if message.is_remote_frame:
+                can_id |= _CAN_RTR_FLAG
+            ids.append(can_id)
+            payloads.append(bytes(message.data))
+            if len(ids) >= self.rx_batch_size:
+                break
+            message = self.can_bus.recv(timeout=0)
+    
     def can_receiver_thread(self):
         """Thread đọc CAN message từ bus"""
-        print(f"CAN Receiver thread đang chạy trên {self.can_interface}...")
+        logger.info("CAN Receiver thread đang chạy trên %s...", self.can_interface)
         
+        receive = self._receive_raw_batch if self.can_socket is not None else self._receive_bus_batch
+        ids = array('I')  # Cột tạm cho một lần đọc
+        payloads = []
+        backoff = _BACKOFF_MIN
         while self.running:
             try:
-                # Đọc message từ CAN bus với timeout
-                message = self.can_bus.recv(timeout=1.0)
+                # Đọc một loạt message từ CAN bus với timeout
+                del ids[:]
+                payloads.clear()
+                receive(1.0, ids, payloads)
+                count = len(ids)
                 
-                if message is not None:
-                    # Xử lý và đưa vào queue
-                    can_msg = {
-                        'timestamp': time.time(),
-                        'id': message.arbitration_id,
-                        'data': message.data.hex(),
-                        'dlc': message.dlc,
-                        'is_extended': message.is_extended_id,
-                        'is_remote': message.is_remote_frame
-                    }
+                if count:
+                    # Đưa cả loạt vào bộ cột để xử lý
+                    with self._rx_lock:
+                        col_ids, col_payloads = self._rx_cols
+                        if len(col_ids) + count <= self.rx_capacity:
+                            col_ids.extend(ids)
+                            col_payloads.extend(payloads)
+                        else:
+                            self.rx_dropped += count
+                    self._rx_event.set()
                     
-                    # Đưa vào queue để xử lý
-                    self.can_rx_queue.put(can_msg)
+                    # Log thỉnh thoảng, chỉ format khi bật DEBUG
+                    previous = self._rx_count
+                    self._rx_count += count
+                    if ((previous ^ self._rx_count) & ~self._log_mask) and logger.isEnabledFor(logging.DEBUG):
+                        data = payloads[-1]
+                        logger.debug("[CAN RX] ID: 0x%03X, Data: %s, DLC: %d",
+                                     ids[-1] & _CAN_EFF_MASK, data.hex(), len(data))
+                backoff = _BACKOFF_MIN
                     
-                    # Log message nhận được
-                    print(f"[CAN RX] ID: {hex(message.arbitration_id)}, "
-                          f"Data: {message.data.hex()}, DLC: {message.dlc}")
-                    
-            except can.CanError as e:
-                print(f"CAN Error: {e}")
+            except (can.CanError, OSError) as e:
+                logger.error("CAN Error: %s", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, _BACKOFF_MAX)
             except Exception as e:
-                print(f"Lỗi trong CAN receiver: {e}")
-                time.sleep(0.1)
+                logger.error("Lỗi trong CAN receiver: %s", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, _BACKOFF_MAX)
     
     def can_transmitter_thread(self):
         """Thread gửi CAN message ra bus"""
-        print("CAN Transmitter thread đang chạy...")
+        logger.info("CAN Transmitter thread đang chạy...")
         
+        tx_queue = self.can_tx_queue
+        send = self.can_socket.send if self.can_socket is not None else self.can_bus.send
+        backoff = _BACKOFF_MIN
         while self.running:
             try:
-                # Lấy message từ queue để gửi (blocking với timeout)
-                message = self.can_tx_queue.get(timeout=1.0)
-                
-                # Tạo CAN message
-                can_msg = can.Message(
-                    arbitration_id=message['id'],
-                    data=bytes.fromhex(message['data']),
-                    is_extended_id=message.get('is_extended', False),
-                    is_remote_frame=message.get('is_remote', False)
-                )
-                
-                # Gửi message
-                self.can_bus.send(can_msg)
+                # Chờ có message để gửi (timeout để kiểm tra self.running)
+                if not self._tx_event.wait(timeout=1.0):
+                    continue
+                self._tx_event.clear()
                 
-                print(f"[CAN TX] Đã gửi: ID={hex(message['id'])}, "
-                      f"Data={message['data']}")
+                while tx_queue:
+                    can_msg = tx_queue.popleft()
+                    
+                    # Gửi message
+                    send(can_msg)
+                    
+                    self._tx_count += 1
+                    if (self._tx_count & self._log_mask) == 0 and logger.isEnabledFor(logging.DEBUG):
+                        if isinstance(can_msg, (bytes, bytearray)):
+                            can_id, dlc, data = _CAN_FRAME.unpack(can_msg)
+                            can_id, data = can_id & ~_CAN_EFF_FLAG, data[:dlc]
+                        else:
+                            can_id, data = can_msg.arbitration_id, can_msg.data
+                        logger.debug("[CAN TX] Đã gửi: ID=0x%03X, Data=%s", can_id, data.hex())
+                backoff = _BACKOFF_MIN
                 
-            except queue.Empty:
-                # Không có message để gửi
-                pass
-            except can.CanError as e:
-                print(f"CAN TX Error: {e}")
+            except (can.CanError, OSError) as e:
+                logger.error("CAN TX Error: %s", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, _BACKOFF_MAX)
             except Exception as e:
-                print(f"Lỗi trong CAN transmitter: {e}")
-                time.sleep(0.1)
+                logger.error("Lỗi trong CAN transmitter: %s", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, _BACKOFF_MAX)
     
     def zone_processor(self):
         """Xử lý CAN message và điều khiển zone"""
@@ -119,46 +274,62 @@ class ZonalControllerCAN:
         ZONE_SENSOR_BASE_ID = 0x100 + self.zone_id
         ZONE_ACTUATOR_BASE_ID = 0x200 + self.zone_id
         
+        next_status = time.monotonic()
+        backoff = _BACKOFF_MIN
         while self.running:
             try:
-                # Xử lý các message nhận được
-                while not self.can_rx_queue.empty():
-                    msg = self.can_rx_queue.get_nowait()
-                    
-                    # Phân tích CAN message
-                    self.process_can_message(msg)
-                    
-                    # Cập nhật dữ liệu zone
-                    self.update_zone_data(msg)
+                # Ngủ đến khi có message mới hoặc đến hạn gửi zone status
+                timeout = next_status - time.monotonic()
+                if timeout > 0:
+                    self._rx_event.wait(timeout)
+                self._rx_event.clear()
                 
-                # Ví dụ: Gửi periodic status message
-                self.send_zone_status()
+                # Lấy các message nhận được (đổi bộ cột, giữ lock rất ngắn)
+                with self._rx_lock:
+                    ids, payloads = self._rx_cols
+                    self._rx_cols = self._rx_spare
+                try:
+                    for can_id, data in zip(ids, payloads):
+                        # Phân tích CAN message
+                        self.process_can_message(can_id, data)
+                        
+                        # Cập nhật dữ liệu zone
+                        self.update_zone_data(can_id, data)
+                finally:
+                    del ids[:]
+                    payloads.clear()
+                    self._rx_spare = (ids, payloads)
+                
+                # Ví dụ: Gửi periodic status message theo deadline monotonic
+                now = time.monotonic()
+                if now >= next_status:
+                    self.send_zone_status()
+                    next_status += self.status_period
+                    if next_status <= now:  # Bị trễ thì không gửi dồn
+                        next_status = now + self.status_period
                 
                 # Xử lý logic điều khiển zone
                 self.control_logic()
-                
-                time.sleep(0.01)  # 10ms cycle
+                backoff = _BACKOFF_MIN
                 
             except Exception as e:
                 print(f"Lỗi trong zone processor: {e}")
-                time.sleep(0.1)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, _BACKOFF_MAX)
     
-    def process_can_message(self, msg):
-        """Phân tích và xử lý CAN message"""
-        can_id = msg['id']
-        data = msg['data']
-        
-        # Ví dụ: Xử lý các loại message khác nhau
-        if can_id == 0x100:  # System status message
-            self.handle_system_status(data)
-        elif 0x200 <= can_id <= 0x2FF:  # Sensor data messages
-            self.handle_sensor_data(can_id, data)
-        elif 0x300 <= can_id <= 0x3FF:  # Actuator control messages
-            self.handle_actuator_command(can_id, data)
+    def process_can_message(self, can_id, data):
+        """Phân tích và xử lý CAN message (can_id thô, frame extended/RTR có cờ bit cao)"""
+        # Ví dụ: Xử lý các loại message khác nhau (tra bảng handler theo ID)
+        if can_id < 0x800:
+            self._handlers[can_id](can_id, data)
+    
+    def _ignore_message(self, can_id, data):
+        """Handler mặc định cho CAN ID không cần xử lý"""
+        pass
     
-    def handle_system_status(self, data):
+    def handle_system_status(self, can_id, data):
         """Xử lý system status message"""
-        status_byte = int(data[:2], 16)
+        status_byte = data[0] if data else 0
         self.zone_data['system_status'] = status_byte
         # Thêm logic xử lý ở đây
     
@@ -178,24 +349,16 @@ class ZonalControllerCAN:
             'timestamp': time.time()
         }
         
-        # Gửi feedback
-        feedback_msg = {
-            'id': 0x400 + actuator_id,
-            'data': data,  # Echo command để confirm
-            'is_extended': False
-        }
-        self.can_tx_queue.put(feedback_msg)
+        # Gửi feedback (echo command để confirm)
+        self.send_can_message(0x400 + actuator_id, data)
     
     def send_zone_status(self):
         """Gửi periodic zone status message"""
-        status_msg = {
-            'id': 0x500 + self.zone_id,
-            'data': f'{self.zone_id:02X}01{int(time.time()) % 256:02X}',  # Ví dụ
-            'is_extended': False
-        }
-        self.can_tx_queue.put(status_msg)
+        self._status_buf[2] = int(time.time()) & 0xFF  # Ví dụ
+        self.can_tx_queue.append(self._status_msg)
+        self._tx_event.set()
     
-    def update_zone_data(self, msg):
+    def update_zone_data(self, can_id, data):
         """Cập nhật dữ liệu zone từ CAN message"""
         # Thêm logic cập nhật ở đây
         pass
@@ -206,13 +369,20 @@ class ZonalControllerCAN:
         pass
     
     def send_can_message(self, can_id, data, is_extended=False):
-        """API để gửi CAN message từ bên ngoài"""
-        message = {
-            'id': can_id,
-            'data': data,
-            'is_extended': is_extended
-        }
-        self.can_tx_queue.put(message)
+        """API để gửi CAN message từ bên ngoài (data là bytes, hoặc chuỗi hex)"""
+        if isinstance(data, str):
+            data = bytes.fromhex(data)
+        if self.can_socket is not None:
+            message = _CAN_FRAME.pack(can_id | _CAN_EFF_FLAG if is_extended else can_id,
+                                      len(data), data)
+        else:
+            message = can.Message(
+                arbitration_id=can_id,
+                data=data,
+                is_extended_id=is_extended
+            )
+        self.can_tx_queue.append(message)
+        self._tx_event.set()
     
     def get_zone_data(self):
         """Lấy dữ liệu zone hiện tại"""
@@ -227,6 +397,11 @@ class ZonalControllerCAN:
         # self.can_tx_thread.start()
         self.zone_processor_thread.start()
         
+        # RX và processor mỗi thread một core để không tranh cache line với nhau
+        rx_core, processor_core = self._pick_cores()
+        self._set_realtime(self.can_rx_thread, rx_core, "CAN RX thread")
+        self._set_realtime(self.zone_processor_thread, processor_core, "Zone processor")
+        
         print(f"Zonal Controller {self.zone_id} đã khởi động")
     
     def stop(self):
@@ -240,6 +415,8 @@ class ZonalControllerCAN:
         self.zone_processor_thread.join(timeout=2)
         
         # Đóng CAN bus
+        if self.can_socket:
+            self.can_socket.close()
         if self.can_bus:
             self.can_bus.shutdown()
         
@@ -5,54 +5,119 @@ Enhanced WSL2 Socket Server: Nhận CAN frame, gửi lên VCAN và forward đế
 
 import socket
 import json
+import struct
 import can
 import time
 import logging
+import asyncio
 import threading
-import queue
-from typing import Optional, Dict, Any, List
+from array import array
+from typing import Optional, Dict, Any, List, Tuple
 import zmq  # ZeroMQ cho inter-process communication
+import msgspec  # msgpack: giải mã payload từ fmu_can_bridge, mã hoá message ZMQ
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # Không có orjson thì dùng json chuẩn
+    _json_loads = json.loads
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("WSL2SocketServer")
 
+# Header độ dài (uint32 big-endian) đứng trước mỗi payload msgpack
+_LENGTH_PREFIX = struct.Struct('>I')
+
+# struct can_frame của SocketCAN: can_id (u32), can_dlc (u8), 3 byte pad, data[8]
+_CAN_FRAME = struct.Struct('=IB3x8s')
+
+# Chuỗi hiển thị cho mọi CAN ID chuẩn (11 bit), tính sẵn thay vì format mỗi lần log
+CAN_ID_STR = tuple(f"0x{i:03X}" for i in range(0x800))
+
+# Topic ZMQ cho mỗi CAN ID (2 byte big-endian), subscriber lọc theo prefix này
+CAN_ID_TOPIC = tuple(i.to_bytes(2, 'big') for i in range(0x800))
+
 class CANForwarder:
     """Forward CAN messages đến các subscribers (Zonal Controllers)"""
     
-    def __init__(self, zmq_port: int = 5555):
+    def __init__(self, zmq_port: int = 5555, batch_size: int = 32, flush_interval: float = 0.001):
         self.zmq_port = zmq_port
         self.context = zmq.Context()
         self.publisher = self.context.socket(zmq.PUB)
+        self.publisher.setsockopt(zmq.SNDHWM, 10_000)
         self.publisher.bind(f"tcp://*:{zmq_port}")
+        self._encoder = msgspec.msgpack.Encoder()
         
-        # Queue để lưu tin nhắn
-        self.message_queue = queue.Queue(maxsize=1000)
+        # Gom message đã serialize theo CAN ID, gửi mỗi ID một multipart:
+        # [topic, message, message, ...] để subscriber lọc ngay trong ZMQ
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval  # Message chờ tối đa ~1ms
+        self._pending: Dict[bytes, List[bytes]] = {}
+        self._pending_count = 0
+        self._lock = threading.Lock()  # Nhiều client thread cùng forward
+        self._has_pending = threading.Event()
         
         # Subscribers tracking
         self.subscribers = set()
         
+        self.running = True
+        self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flush_thread.start()
+        
         logger.info(f"ZMQ Publisher started on port {zmq_port}")
     
     def forward_message(self, can_data: Dict[str, Any]):
         """Forward CAN message đến Zonal Controllers"""
         try:
-            # Gửi qua ZMQ
-            self.publisher.send_json(can_data)
-            
-            # Cũng đưa vào queue cho backup
-            try:
-                self.message_queue.put_nowait(can_data)
-            except queue.Full:
-                # Nếu queue đầy, bỏ tin cũ nhất
-                try:
-                    self.message_queue.get_nowait()
-                    self.message_queue.put_nowait(can_data)
-                except:
-                    pass
+            # Serialize ngay (msgpack, can_data giữ nguyên bytes), gửi theo batch
+            frame = self._encoder.encode(can_data)
+            topic = CAN_ID_TOPIC[can_data['can_id']]
+            with self._lock:
+                frames = self._pending.get(topic)
+                if frames is None:
+                    self._pending[topic] = [topic, frame]
+                else:
+                    frames.append(frame)
+                self._pending_count += 1
+                if self._pending_count >= self.batch_size:
+                    self._flush_locked()
+                else:
+                    self._has_pending.set()
             
         except Exception as e:
             logger.error(f"Forward error: {e}")
     
+    def _flush_locked(self):
+        """Gửi các message đang chờ (gọi khi đang giữ self._lock)"""
+        if not self._pending:
+            return
+        # PUB không bao giờ block: khi tới SNDHWM (subscriber chậm) ZMQ tự bỏ message
+        for frames in self._pending.values():
+            self.publisher.send_multipart(frames)
+        self._pending = {}
+        self._pending_count = 0
+    
+    def _flush_loop(self):
+        """Gửi batch chưa đầy sau flush_interval để message không bị giữ lâu"""
+        while self.running:
+            if not self._has_pending.wait(timeout=0.5):
+                continue
+            time.sleep(self.flush_interval)
+            with self._lock:
+                self._has_pending.clear()
+                self._flush_locked()
+    
+    def close(self):
+        """Gửi nốt batch còn lại và đóng ZMQ"""
+        self.running = False
+        if self.publisher.closed:
+            return
+        with self._lock:
+            self._flush_locked()
+        self._flush_thread.join(timeout=1.0)
+        self.publisher.close(linger=0)  # Không chờ subscriber chậm khi dừng
+        self.context.term()
+    
     def get_subscriber_count(self) -> int:
         """Lấy số lượng subscribers"""
         return len(self.subscribers)
@@ -77,92 +142,184 @@ class CANMessageProcessor:
             'total_sent': 0,
             'invalid_ids': 0,
             'invalid_data': 0,
-            'by_id': {}
+            # Đếm theo CAN ID chuẩn 11 bit: bảng cố định 2048 ô, index trực tiếp
+            'by_id': array('Q', bytes(8 * 2048))
+        }
+        self._by_id = self.stats['by_id']
+        
+        # Metadata cố định gắn vào mọi message hợp lệ (một lần dict.update)
+        self._static_fields = {
+            'direction': 'RX',  # Received from external
+            'source': 'vECU',
+            'destination': 'ZonalController',
+            'validated': True,
         }
+        
+        # timestamp_iso chỉ đổi mỗi giây, cache lại thay vì strftime mỗi message
+        self._iso_cache_sec = -1
+        self._iso_cache_str = ''
     
-    def validate_message(self, data: Dict[str, Any]) -> bool:
-        """Validate CAN message"""
-        # Kiểm tra required fields
-        required_fields = ['can_id', 'can_data', 'dlc']
-        for field in required_fields:
-            if field not in data:
-                logger.error(f"Missing required field: {field}")
-                return False
-        
-        # Validate CAN ID
-        can_id = data['can_id']
-        if not (0x000 <= can_id <= 0x7FF):  # Standard CAN ID range
-            logger.error(f"Invalid CAN ID: 0x{can_id:X}")
-            self.stats['invalid_ids'] += 1
-            return False
-        
-        # Validate DLC
-        dlc = data['dlc']
-        if not (0 <= dlc <= 8):
-            logger.error(f"Invalid DLC: {dlc}")
-            return False
-        
-        # Validate data length
-        can_data = data['can_data']
+    def validate_message(self, data: Dict[str, Any]) -> Optional[Tuple[int, Any, int]]:
+        """Validate CAN message, trả về (can_id, can_data, dlc) nếu hợp lệ"""
+        try:
+            can_id = data['can_id']
+            can_data = data['can_data']
+            dlc = data['dlc']
+        except KeyError as e:
+            logger.error(f"Missing required field: {e.args[0]}")
+            return None
+        
+        try:
+            # Validate CAN ID (standard 0x000-0x7FF: không có bit nào ngoài 11 bit thấp)
+            if can_id & ~0x7FF:
+                logger.error(f"Invalid CAN ID: 0x{can_id:X}")
+                self.stats['invalid_ids'] += 1
+                return None
+            
+            # Validate DLC (0-8)
+            if (dlc & ~0x0F) or dlc > 8:
+                logger.error(f"Invalid DLC: {dlc}")
+                return None
+        except TypeError:
+            logger.error(f"Invalid field type: can_id={can_id!r}, dlc={dlc!r}")
+            return None
+        
+        # Validate data length (payload dạng chuỗi hex được giải mã một lần tại đây)
+        if isinstance(can_data, str):
+            try:
+                can_data = data['can_data'] = bytes.fromhex(can_data)
+            except ValueError:
+                logger.error(f"Invalid hex data: {can_data[:32]!r}")
+                self.stats['invalid_data'] += 1
+                return None
         if len(can_data) != 8:
             logger.error(f"Invalid data length: {len(can_data)}")
             self.stats['invalid_data'] += 1
-            return False
+            return None
         
-        return True
+        return can_id, can_data, dlc
     
     def process_message(self, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Xử lý và enrich CAN message"""
         self.stats['total_received'] += 1
         
         # Validate
-        if not self.validate_message(data):
+        fields = self.validate_message(data)
+        if fields is None:
             return None
+        can_id = fields[0]
         
-        # Thêm metadata
-        enriched_data = {
-            **data,
-            'timestamp_ns': time.time_ns(),
-            'timestamp_iso': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
-            'direction': 'RX',  # Received from external
-            'source': 'vECU',
-            'destination': 'ZonalController',
-            'validated': True,
-        }
+        # Thêm metadata (ghi thẳng vào dict vừa decode, không tạo dict mới)
+        ns = time.time_ns()
+        sec = ns // 1_000_000_000
+        if sec != self._iso_cache_sec:
+            self._iso_cache_sec = sec
+            self._iso_cache_str = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(sec))
+        
+        enriched_data = data
+        enriched_data['timestamp_ns'] = ns
+        enriched_data['timestamp_iso'] = self._iso_cache_str
+        enriched_data.update(self._static_fields)
         
         # Thêm CAN ID description nếu có
-        can_id = data['can_id']
-        if can_id in self.valid_ids:
-            enriched_data['can_id_description'] = self.valid_ids[can_id]
+        description = self.valid_ids.get(can_id)
+        if description is not None:
+            enriched_data['can_id_description'] = description
         
         # Update statistics
-        if can_id not in self.stats['by_id']:
-            self.stats['by_id'][can_id] = 0
-        self.stats['by_id'][can_id] += 1
+        self._by_id[can_id] += 1
         
         return enriched_data
 
+class ClientConnection(asyncio.BufferedProtocol):
+    """Một kết nối client: event loop recv_into thẳng vào buffer dùng lại của kết nối"""
+    
+    def __init__(self, server: 'EnhancedWSL2SocketServer', connections: set):
+        self.server = server
+        self.connections = connections  # Các kết nối đang mở trên cùng event loop
+        self.transport = None
+        self.client_address = None
+        self._recv_buf = bytearray(65536)
+        self._recv_view = memoryview(self._recv_buf)
+        self._buffer = bytearray()
+        self._use_msgpack = None  # Xác định theo byte đầu tiên của kết nối
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connections.add(self)
+        self.client_address = transport.get_extra_info('peername')
+        # Frame nhỏ, gửi liên tục: tắt Nagle và tăng receive buffer
+        client_socket = transport.get_extra_info('socket')
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        
+        self.server.stats['connections'] += 1
+        self.server.client_connected = True
+        logger.info(f"New connection from {self.client_address}")
+    
+    def get_buffer(self, sizehint: int):
+        return self._recv_view
+    
+    def buffer_updated(self, nbytes: int):
+        server = self.server
+        try:
+            server.stats['bytes_received'] += nbytes
+            buffer = self._buffer
+            buffer += self._recv_view[:nbytes]
+            
+            # JSON (debug) luôn bắt đầu bằng '{', msgpack bắt đầu bằng header độ dài
+            if self._use_msgpack is None:
+                self._use_msgpack = buffer[:1] != b'{'
+            
+            # Xử lý từng message hoàn chỉnh (phần đã xử lý bị xóa khỏi buffer)
+            for payload in server.process_buffer(buffer, self._use_msgpack):
+                server.process_incoming_message(payload, self.client_address, self._use_msgpack)
+        except Exception as e:
+            logger.error(f"Client handling error: {e}")
+            server.stats['errors'] += 1
+            self.transport.close()
+    
+    def eof_received(self):
+        logger.info(f"Client {self.client_address} disconnected")
+        return False
+    
+    def connection_lost(self, exc):
+        if isinstance(exc, ConnectionResetError):
+            logger.warning(f"Connection reset by {self.client_address}")
+        self.connections.discard(self)
+        self.server.client_connected = False
+        logger.info(f"Client {self.client_address} connection closed")
+
 class EnhancedWSL2SocketServer:
     """Enhanced socket server với CAN forwarding"""
     
     def __init__(self, host: str = '0.0.0.0', port: int = 8888, 
-                 zmq_port: int = 5555, can_interface: str = 'vcan0'):
+                 zmq_port: int = 5555, can_interface: str = 'vcan0',
+                 accept_threads: int = 2):
         self.host = host
         self.port = port
         self.zmq_port = zmq_port
         self.can_interface = can_interface
+        # Số listening socket (SO_REUSEPORT), mỗi socket một event loop trong thread riêng
+        self.accept_threads = max(1, accept_threads)
         
         # Core components
         self.processor = CANMessageProcessor()
         self.forwarder = CANForwarder(zmq_port)
+        self._decoder = msgspec.msgpack.Decoder()
         
         # Network components
         self.server_socket = None
+        self.server_sockets: List[socket.socket] = []
+        self._reactors: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
         self.can_bus = None
+        self.can_socket = None  # Raw PF_CAN socket để gửi, None thì dùng python-can
         
         # State
         self.running = False
         self.client_connected = False
+        self._stopped = False
+        self._stop_lock = threading.Lock()  # stop() được gọi từ main và từ thread event loop
         
         # Initialize
         self.setup_can()
@@ -196,6 +353,16 @@ class EnhancedWSL2SocketServer:
                 subprocess.run(['sudo', 'ip', 'link', 'set', 'up', self.can_interface],
                              capture_output=True)
             
+            # Gửi bằng raw PF_CAN socket (ghi thẳng struct can_frame, bỏ qua can.Message)
+            try:
+                self.can_socket = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+                self.can_socket.bind((self.can_interface,))
+                logger.info(f"Connected to CAN interface: {self.can_interface} (raw socket)")
+                return
+            except (AttributeError, OSError) as e:
+                logger.warning(f"Raw CAN socket unavailable ({e}), using python-can")
+                self.can_socket = None
+            
             # Kết nối đến CAN bus
             self.can_bus = can.interface.Bus(
                 channel=self.can_interface,
@@ -207,110 +374,96 @@ class EnhancedWSL2SocketServer:
             logger.error(f"Cannot setup CAN: {e}")
             raise
     
+    def _create_listener(self) -> socket.socket:
+        """Tạo listening socket; SO_REUSEPORT để nhiều socket cùng bind, kernel chia kết nối"""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(5)  # Tăng backlog để nhiều client
+        server_socket.setblocking(False)
+        return server_socket
+    
     def start(self):
         """Bắt đầu server"""
-        # Tạo socket server
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)  # Tăng backlog để nhiều client
-        self.server_socket.settimeout(1.0)
-        
-        logger.info(f"Socket server listening on {self.host}:{self.port}")
+        # Tạo socket server (không có SO_REUSEPORT thì chỉ một socket)
+        listeners = self.accept_threads if hasattr(socket, 'SO_REUSEPORT') else 1
+        self.server_sockets = [self._create_listener() for _ in range(listeners)]
+        self.server_socket = self.server_sockets[0]
+        
+        logger.info(f"Socket server listening on {self.host}:{self.port} ({listeners} event loops)")
         logger.info(f"ZMQ Publisher on port {self.zmq_port}")
         logger.info(f"CAN Interface: {self.can_interface}")
         
         self.running = True
         self.monitor_thread.start()
         
+        for server_socket in self.server_sockets[1:]:
+            threading.Thread(target=self.run_reactor, args=(server_socket,), daemon=True).start()
+        
         try:
-            while self.running:
-                try:
-                    client_socket, client_address = self.server_socket.accept()
-                    self.stats['connections'] += 1
-                    logger.info(f"New connection from {client_address}")
-                    
-                    # Xử lý client trong thread riêng
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket, client_address),
-                        daemon=True
-                    )
-                    client_thread.start()
-                    
-                except socket.timeout:
-                    continue
-                except KeyboardInterrupt:
-                    break
-                except Exception as e:
-                    logger.error(f"Accept error: {e}")
-                    time.sleep(1)
-                    
+            self.run_reactor(self.server_socket)
         finally:
             self.stop()
     
-    def handle_client(self, client_socket: socket.socket, client_address: tuple):
-        """Xử lý client connection"""
-        client_socket.settimeout(1.0)
-        buffer = ""
-        self.client_connected = True
-        
+    def run_reactor(self, server_socket: socket.socket):
+        """Chạy một event loop phục vụ mọi client của một listening socket"""
+        asyncio.run(self._serve(server_socket))
+    
+    async def _serve(self, server_socket: socket.socket):
+        """Accept và đọc client trên event loop hiện tại đến khi server dừng"""
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        connections = set()
+        self._reactors.append((loop, stopped))
+        server = await loop.create_server(lambda: ClientConnection(self, connections),
+                                          sock=server_socket)
         try:
-            while self.running and self.client_connected:
-                try:
-                    # Nhận dữ liệu
-                    data = client_socket.recv(65536)  # Tăng buffer size
-                    if not data:
-                        logger.info(f"Client {client_address} disconnected")
-                        break
-                    
-                    self.stats['bytes_received'] += len(data)
-                    buffer += data.decode('utf-8', errors='ignore')
-                    
-                    # Xử lý các messages
-                    processed = self.process_buffer(buffer)
-                    buffer = processed['remaining_buffer']
-                    
-                    # Xử lý từng message
-                    for message_str in processed['messages']:
-                        self.process_incoming_message(message_str, client_address)
-                        
-                except socket.timeout:
-                    continue
-                except ConnectionResetError:
-                    logger.warning(f"Connection reset by {client_address}")
-                    break
-                except Exception as e:
-                    logger.error(f"Client handling error: {e}")
-                    self.stats['errors'] += 1
-                    break
-                    
+            if self.running:
+                await stopped.wait()
         finally:
-            client_socket.close()
-            self.client_connected = False
-            logger.info(f"Client {client_address} connection closed")
+            server.close()
+            for connection in list(connections):
+                connection.transport.close()
+            await asyncio.sleep(0)  # Cho connection_lost chạy trước khi loop đóng
     
-    def process_buffer(self, buffer: str) -> Dict[str, Any]:
-        """Xử lý buffer và trích xuất các messages hoàn chỉnh"""
+    def process_buffer(self, buffer: bytearray, use_msgpack: bool = True) -> List[bytes]:
+        """Trích xuất các messages hoàn chỉnh, xóa phần đã xử lý khỏi buffer một lần"""
         messages = []
-        
-        # Phân tách bằng newline
-        while '\n' in buffer:
-            message, buffer = buffer.split('\n', 1)
-            message = message.strip()
-            if message:
-                messages.append(message)
-        
-        return {
-            'messages': messages,
-            'remaining_buffer': buffer
-        }
+        pos = 0
+        end = len(buffer)
+        
+        if use_msgpack:
+            # Phân tách theo header độ dài
+            header_size = _LENGTH_PREFIX.size
+            while end - pos >= header_size:
+                (length,) = _LENGTH_PREFIX.unpack_from(buffer, pos)
+                start = pos + header_size
+                if end - start < length:
+                    break
+                messages.append(bytes(buffer[start:start + length]))
+                pos = start + length
+        else:
+            # Phân tách bằng newline
+            while True:
+                idx = buffer.find(b'\n', pos)
+                if idx < 0:
+                    break
+                message = bytes(buffer[pos:idx]).strip()
+                if message:
+                    messages.append(message)
+                pos = idx + 1
+        
+        if pos:
+            del buffer[:pos]
+        return messages
     
-    def process_incoming_message(self, message_str: str, source: tuple):
+    def process_incoming_message(self, payload: bytes, source: tuple, use_msgpack: bool = True):
         """Xử lý một incoming message"""
         try:
-            # Parse JSON
-            data = json.loads(message_str)
+            # Parse msgpack (mặc định) hoặc JSON
+            data = self._decoder.decode(payload) if use_msgpack else _json_loads(payload)
             self.stats['messages_received'] += 1
             
             # Process message
@@ -329,9 +482,9 @@ class EnhancedWSL2SocketServer:
             if self.stats['messages_received'] % 100 == 0:
                 logger.info(f"Processed {self.stats['messages_received']} messages from {source}")
                 
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error from {source}: {e}")
-            logger.debug(f"Raw message: {message_str[:100]}...")
+        except (json.JSONDecodeError, msgspec.DecodeError) as e:
+            logger.error(f"Decode error from {source}: {e}")
+            logger.debug(f"Raw message: {payload[:100]!r}...")
             self.stats['errors'] += 1
         except Exception as e:
             logger.error(f"Message processing error: {e}")
@@ -344,23 +497,24 @@ class EnhancedWSL2SocketServer:
             can_data = data['can_data']
             dlc = data['dlc']
             
-            # Đảm bảo data là bytes
-            if isinstance(can_data, list):
+            # Đảm bảo data là bytes (msgpack gửi bytes, JSON gửi list int hoặc hex đã giải mã)
+            if isinstance(can_data, (bytes, bytearray, list)):
                 can_data_bytes = bytes(can_data[:dlc])
             else:
                 logger.error(f"Invalid can_data format: {type(can_data)}")
                 return
             
-            # Tạo CAN message
-            message = can.Message(
-                arbitration_id=can_id,
-                data=can_data_bytes,
-                is_extended_id=False,
-                dlc=dlc
-            )
-            
             # Gửi
-            self.can_bus.send(message)
+            if self.can_socket is not None:
+                self.can_socket.send(_CAN_FRAME.pack(can_id, dlc, can_data_bytes))
+            else:
+                message = can.Message(
+                    arbitration_id=can_id,
+                    data=can_data_bytes,
+                    is_extended_id=False,
+                    dlc=dlc
+                )
+                self.can_bus.send(message)
             self.stats['messages_sent_to_can'] += 1
             
             # Log chi tiết (thỉnh thoảng)
@@ -369,7 +523,7 @@ class EnhancedWSL2SocketServer:
                 headlamp_bit = (can_data_bytes[0] & 0x01) != 0
                 light_level = can_data_bytes[1] if len(can_data_bytes) > 1 else 0
                 
-                logger.info(f"CAN Sent: ID=0x{can_id:03X}, "
+                logger.info(f"CAN Sent: ID={CAN_ID_STR[can_id]}, "
                           f"Headlamp={'ON' if headlamp_bit else 'OFF'}, "
                           f"Light={light_level}%")
                 
@@ -400,20 +554,29 @@ class EnhancedWSL2SocketServer:
     
     def stop(self):
         """Dừng server"""
+        with self._stop_lock:
+            if self._stopped:
+                return
+            self._stopped = True
         self.running = False
         self.client_connected = False
         
-        # Đóng sockets
-        if self.server_socket:
-            self.server_socket.close()
+        # Dừng các event loop (loop tự đóng listening socket và các kết nối)
+        for loop, stopped in self._reactors:
+            try:
+                loop.call_soon_threadsafe(stopped.set)
+            except RuntimeError:
+                pass  # Loop đã đóng
+        self._reactors.clear()
         
+        if self.can_socket:
+            self.can_socket.close()
         if self.can_bus:
             self.can_bus.shutdown()
         
         # Đóng ZMQ
         if hasattr(self, 'forwarder'):
-            self.forwarder.publisher.close()
-            self.forwarder.context.term()
+            self.forwarder.close()
         
         # Hiển thị final statistics
         self.print_final_statistics()
@@ -440,9 +603,11 @@ class EnhancedWSL2SocketServer:
         # Processor statistics
         logger.info("\nProcessor Statistics:")
         proc_stats = self.processor.stats
-        for can_id, count in proc_stats['by_id'].items():
+        for can_id, count in enumerate(proc_stats['by_id']):
+            if not count:
+                continue
             desc = self.processor.valid_ids.get(can_id, "Unknown")
-            logger.info(f"  0x{can_id:03X} ({desc}): {count} messages")
+            logger.info(f"  {CAN_ID_STR[can_id]} ({desc}): {count} messages")
         
         logger.info("="*60)
 
@@ -459,6 +624,8 @@ def main():
                        help='ZMQ publisher port')
     parser.add_argument('--can-interface', type=str, default='vcan0',
                        help='CAN interface name')
+    parser.add_argument('--accept-threads', type=int, default=2,
+                       help='Number of SO_REUSEPORT listeners, one event loop thread each')
     parser.add_argument('--log-file', type=str,
                        help='Log file path')
     parser.add_argument('--verbose', action='store_true',
@@ -484,7 +651,8 @@ def main():
         host=args.host,
         port=args.port,
         zmq_port=args.zmq_port,
-        can_interface=args.can_interface
+        can_interface=args.can_interface,
+        accept_threads=args.accept_threads
     )
     
     try:
@@ -3,47 +3,111 @@
 Zonal Controller: Nhận CAN messages, decode bằng DBC, map sang VSS
 """
 
+import os
+import sys
+import mmap
+import pickle
 import zmq
 import can
+import msgspec
 import cantools
 import json
 import time
 import logging
 import threading
-from typing import Dict, Any, Optional, List
-from dataclasses import dataclass, asdict, field
+import queue
+import selectors
+from typing import Dict, Any, Optional, List, Tuple
+from dataclasses import dataclass
 from datetime import datetime
 import sqlite3
 import yaml
 from pathlib import Path
 
+try:
+    import numpy as np
+except ImportError:  # Không có numpy thì chỉ decode từng message
+    np = None
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("ZonalController")
 
-@dataclass
-class CANSignal:
-    """Biểu diễn một CAN signal"""
+# Đặt ZC_DBC_CACHE=0 để tắt cache DBC đã parse (<dbc>.cache.pkl)
+_DBC_CACHE_ENV = "ZC_DBC_CACHE"
+
+# Loader YAML dùng libyaml (C) nếu PyYAML được build kèm, không thì bản Python thuần
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# File YAML từ ngưỡng này trở lên được mmap thay vì đọc qua file object
+_YAML_MMAP_MIN = 1 << 20
+
+def _load_yaml_file(path: str):
+    """Parse file YAML; file lớn thì mmap để parser đọc thẳng từ page cache"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < _YAML_MMAP_MIN:
+            return yaml.load(f, Loader=_YAML_LOADER)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return yaml.load(mm, Loader=_YAML_LOADER)
+
+# Byte đệm cho payload ngắn hơn 8 byte, _PAD[n] là n byte 0
+_PAD = tuple(bytes(i) for i in range(9))
+
+_SQLITE_PAGE_SIZE = 8192
+_SQLITE_PRAGMAS = f'''
+    PRAGMA page_size={_SQLITE_PAGE_SIZE};
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-65536;
+'''
+
+# Câu lệnh INSERT dùng cho executemany (sqlite3 cache statement theo text)
+_INSERT_CAN = '''
+    INSERT INTO can_messages 
+    (timestamp, can_id, can_id_hex, can_id_description, raw_data, dlc, direction, source, signals_json)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+_INSERT_VSS = '''
+    INSERT INTO vss_signals 
+    (timestamp, vss_path, vss_value, data_type, unit, description, source_can_id, source_signal_name)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Signals của một message lưu chung một cột JSON: [[name, value, unit], ...]
+# (giá trị NamedSignalValue của cantools ghi bằng số thô)
+_signals_encoder = msgspec.json.Encoder(enc_hook=lambda obj: getattr(obj, 'value', str(obj)))
+
+def _signals_json(signals) -> str:
+    """Mã hoá list (meta, value) thành JSON cho cột signals_json"""
+    return _signals_encoder.encode([(meta.name, value, meta.unit) for meta, value in signals]).decode()
+
+# Dataclass dùng __slots__ (không có __dict__ cho mỗi object) khi Python >= 3.10
+_DATACLASS_OPTIONS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+@dataclass(frozen=True, **_DATACLASS_OPTIONS)
+class SignalMeta:
+    """Metadata bất biến của một CAN signal, dựng một lần lúc load DBC và dùng chung"""
     name: str
-    value: Any
     unit: str = ""
     min_value: float = 0.0
     max_value: float = 0.0
     description: str = ""
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class CANMessage:
     """Biểu diễn một CAN message đã decode"""
     timestamp: float
     can_id: int
     can_id_hex: str
-    signals: List[CANSignal]
+    signals: List[Tuple[SignalMeta, Any]]  # (metadata, giá trị) cho từng signal
     raw_data: bytes
     dlc: int
     can_id_description: str = ""
     direction: str = "RX"
     source: str = ""
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class VSSSignal:
     """Biểu diễn một VSS signal"""
     path: str
@@ -58,18 +122,39 @@ class VSSSignal:
 class DBCManager:
     """Quản lý DBC database"""
     
-    def __init__(self, dbc_path: str):
+    def __init__(self, dbc_path: str, mapped_ids=None, save_unmapped: bool = True):
         self.dbc_path = dbc_path
         self.db = None
         self.load_database()
         
-        # Cache cho message definitions
+        # CAN ID có VSS mapping (None = coi như mọi ID đều cần decode signal).
+        # ID ngoài tập này chỉ giữ raw_data nếu không bật save_unmapped
+        self._mapped_ids = set(mapped_ids) if mapped_ids is not None else None
+        self._save_unmapped = save_unmapped
+        
+        # Cache cho message definitions (key là frame_id)
         self.message_cache = {}
+        # SignalMeta theo tên cho từng frame_id (codec và cold path dùng chung)
+        self._signal_meta = {}
+        # Chuỗi "0x%03X" theo CAN ID, tính một lần
+        self._hex = {}
+        # Tên các signal nối bằng ", " theo CAN ID (cột source_signal_name của VSS)
+        self.joined_signal_names = {}
+        # Codec dựng sẵn theo frame_id: list tuple (meta, shift, mask, sign_bit, scale, offset,
+        # is_bool) cho signal little-endian
+        self._codecs = {}
+        self.build_codecs()
+        
+        # CAN ID đã cảnh báo (không có DBC / cantools decode lỗi): chỉ warn một lần mỗi ID
+        self._warned_unknown = set()
         
     def load_database(self):
         """Load DBC file"""
         try:
-            self.db = cantools.database.load_file(self.dbc_path)
+            self.db = self.load_cached_database()
+            if self.db is None:
+                self.db = cantools.database.load_file(self.dbc_path)
+                self.save_cached_database()
             logger.info(f"Loaded DBC database from {self.dbc_path}")
             logger.info(f"Messages: {len(self.db.messages)}")
             
@@ -82,6 +167,46 @@ class DBCManager:
             # Tạo database ảo nếu file không tồn tại
             self.create_virtual_database()
     
+    def _cache_key(self) -> tuple:
+        """Khoá cache: mtime, size của file DBC và phiên bản cantools (pickle phụ thuộc class)"""
+        return (os.path.getmtime(self.dbc_path), os.path.getsize(self.dbc_path), cantools.__version__)
+    
+    def load_cached_database(self):
+        """Đọc database đã parse từ file <dbc>.cache.pkl nếu còn khớp với file DBC"""
+        if os.environ.get(_DBC_CACHE_ENV, "1") == "0":
+            return None
+        
+        cache_path = self.dbc_path + '.cache.pkl'
+        try:
+            with open(cache_path, 'rb') as f:
+                key, db = pickle.load(f)
+            if key == self._cache_key():
+                logger.info(f"Loaded parsed DBC from cache {cache_path}")
+                return db
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring DBC cache {cache_path}: {e}")
+        return None
+    
+    def save_cached_database(self):
+        """Ghi database vừa parse ra file cache (best-effort, lỗi thì bỏ qua)"""
+        if os.environ.get(_DBC_CACHE_ENV, "1") == "0":
+            return
+        
+        cache_path = self.dbc_path + '.cache.pkl'
+        tmp_path = cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((self._cache_key(), self.db), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            logger.warning(f"Cannot write DBC cache {cache_path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    
     def create_virtual_database(self):
         """Tạo virtual database cho CAN ID 0x100 nếu không có DBC file"""
         logger.warning(f"DBC file not found at {self.dbc_path}, creating virtual database")
@@ -185,60 +310,88 @@ class DBCManager:
         self.db.messages.append(light_control_msg)
         logger.info("Created virtual database with LIGHT_CONTROL message (0x100)")
     
-    def decode_message(self, can_id: int, data: bytes) -> Optional[CANMessage]:
-        """Decode CAN message sử dụng DBC"""
+    def build_codecs(self):
+        """Dựng message cache và bảng codec bit-field cho từng frame_id sau khi load DBC"""
+        self.message_cache = {msg.frame_id: msg for msg in self.db.messages}
+        self._signal_meta = {
+            frame_id: {s.name: SignalMeta(s.name, s.unit or "", s.minimum or 0.0, s.maximum or 0.0,
+                                          getattr(s, 'comment', '') or "")
+                       for s in msg.signals}
+            for frame_id, msg in self.message_cache.items()
+        }
+        self._hex = {frame_id: f"0x{frame_id:03X}" for frame_id in self.message_cache}
+        self.joined_signal_names = {frame_id: ", ".join(s.name for s in msg.signals)
+                                    for frame_id, msg in self.message_cache.items()}
+        self._codecs = {}
+        
+        for frame_id, msg in self.message_cache.items():
+            # Chỉ tự decode được signal little-endian, số nguyên, không multiplex;
+            # message khác vẫn đi qua cantools (cold path)
+            if msg.length > 8 or msg.is_multiplexed() or any(s.byte_order != 'little_endian' or s.is_float
+                                           for s in msg.signals):
+                continue
+            
+            metas = self._signal_meta[frame_id]
+            codec = []
+            for s in msg.signals:
+                scale = s.scale if s.scale is not None else 1
+                offset = s.offset if s.offset is not None else 0
+                codec.append((
+                    metas[s.name],
+                    s.start,
+                    (1 << s.length) - 1,
+                    1 << (s.length - 1) if s.is_signed else 0,
+                    scale,
+                    offset,
+                    s.length == 1 and not s.is_signed and scale == 1 and offset == 0
+                ))
+            self._codecs[frame_id] = codec
+        
+        logger.info(f"Built fast codecs for {len(self._codecs)}/{len(self.message_cache)} messages")
+    
+    def needs_signals(self, can_id: int) -> bool:
+        """CAN ID có cần decode từng signal không (có VSS mapping hoặc bật save_unmapped)"""
+        return self._save_unmapped or self._mapped_ids is None or can_id in self._mapped_ids
+    
+    def can_id_hex(self, can_id: int) -> str:
+        """Chuỗi hiển thị CAN ID (cache theo ID)"""
+        can_id_hex = self._hex.get(can_id)
+        if can_id_hex is None:
+            can_id_hex = self._hex[can_id] = f"0x{can_id:03X}"
+        return can_id_hex
+    
+    def decode_message(self, can_id: int, data: bytes, ts: Optional[float] = None) -> Optional[CANMessage]:
+        """Decode CAN message sử dụng DBC (ts: timestamp dùng chung cho cả lượt poll)"""
         try:
             # Đảm bảo data đủ 8 bytes
-            if len(data) < 8:
-                data = data + bytes(8 - len(data))
+            n = len(data)
+            if n < 8:
+                data = data + _PAD[8 - n]
             
             # Tìm message definition
-            if can_id not in self.message_cache:
-                for msg in self.db.messages:
-                    if msg.frame_id == can_id:
-                        self.message_cache[can_id] = msg
-                        break
-            
-            if can_id not in self.message_cache:
-                logger.warning(f"No DBC definition for CAN ID 0x{can_id:03X}")
+            msg_def = self.message_cache.get(can_id)
+            if msg_def is None:
+                if can_id not in self._warned_unknown:
+                    self._warned_unknown.add(can_id)
+                    logger.warning("No DBC definition for CAN ID 0x%03X", can_id)
                 return None
             
-            msg_def = self.message_cache[can_id]
-            
-            try:
-                # Decode signals
-                decoded_signals = self.db.decode_message(can_id, data)
-            except Exception as decode_error:
-                logger.warning(f"Standard decode failed for 0x{can_id:03X}: {decode_error}")
-                # Thử decode thủ công
-                decoded_signals = self.manual_decode(can_id, data, msg_def)
-            
-            # Tạo CANSignal objects
-            signals = []
-            for signal_name, signal_value in decoded_signals.items():
-                # Tìm signal definition
-                signal_def = None
-                for s in msg_def.signals:
-                    if s.name == signal_name:
-                        signal_def = s
-                        break
-                
-                if signal_def:
-                    signal = CANSignal(
-                        name=signal_name,
-                        value=signal_value,
-                        unit=signal_def.unit or "",
-                        min_value=signal_def.minimum or 0.0,
-                        max_value=signal_def.maximum or 0.0,
-                        description=getattr(signal_def, 'comment', '') or ""
-                    )
-                    signals.append(signal)
+            codec = self._codecs.get(can_id)
+            if not self.needs_signals(can_id):
+                # Không có VSS mapping: chỉ lưu raw_data, bỏ qua tách signal
+                signals = []
+            elif codec is not None:
+                # Hot path: đọc payload thành một số nguyên little-endian rồi tách bit-field
+                raw = int.from_bytes(data[:8], 'little')
+                signals = self._decode_codec(codec, raw)
+            else:
+                signals = self.decode_signals(can_id, data, msg_def)
             
             # Tạo CANMessage
             can_msg = CANMessage(
-                timestamp=time.time(),
+                timestamp=ts if ts is not None else time.time(),
                 can_id=can_id,
-                can_id_hex=f"0x{can_id:03X}",
+                can_id_hex=self._hex[can_id],
                 signals=signals,
                 raw_data=data,
                 dlc=len(data),
@@ -249,9 +402,85 @@ class DBCManager:
             return can_msg
             
         except Exception as e:
-            logger.error(f"Failed to decode message 0x{can_id:03X}: {e}")
+            logger.error("Failed to decode message 0x%03X: %s", can_id, e)
             return None
     
+    def decode_batch(self, ids, payloads):
+        """Decode cả lô bằng numpy: ids (N,) int32, payloads (N, 8) uint8 đã pad.
+        
+        Trả về ({can_id: (index, columns)}, leftover) với columns là list
+        (meta, values) và leftover là index các frame không có codec
+        (cần decode từng message).
+        """
+        words = payloads.view('<u8').ravel()
+        groups = {}
+        leftover = []
+        
+        for can_id in np.unique(ids).tolist():
+            index = np.flatnonzero(ids == can_id)
+            if not self.needs_signals(can_id) and can_id in self.message_cache:
+                groups[can_id] = (index, [])
+                continue
+            
+            codec = self._codecs.get(can_id)
+            if codec is None:
+                leftover.extend(index.tolist())
+                continue
+            
+            batch = words[index]
+            columns = []
+            for meta, shift, mask, sign_bit, scale, offset, is_bool in codec:
+                values = (batch >> np.uint64(shift)) & np.uint64(mask)
+                if is_bool:
+                    values = values != 0
+                else:
+                    values = values.astype(np.int64)
+                    if sign_bit:
+                        values = np.where(values & sign_bit, values - (sign_bit << 1), values)
+                    if scale != 1 or offset != 0:
+                        values = values * scale + offset
+                columns.append((meta, values))
+            groups[can_id] = (index, columns)
+        
+        return groups, leftover
+    
+    def _decode_codec(self, codec, raw: int) -> List[Tuple[SignalMeta, Any]]:
+        """Tách signal từ payload (số nguyên little-endian) theo bảng codec"""
+        signals = []
+        for meta, shift, mask, sign_bit, scale, offset, is_bool in codec:
+            value = (raw >> shift) & mask
+            if is_bool:
+                value = value != 0
+            else:
+                if value & sign_bit:
+                    value -= sign_bit << 1
+                if scale != 1 or offset != 0:
+                    value = value * scale + offset
+            signals.append((meta, value))
+        return signals
+    
+    def decode_signals(self, can_id: int, data: bytes, msg_def) -> List[Tuple[SignalMeta, Any]]:
+        """Decode bằng cantools cho message không có codec (big-endian, float, multiplex)"""
+        try:
+            # Decode signals
+            decoded_signals = self.db.decode_message(can_id, data)
+        except Exception as decode_error:
+            if can_id not in self._warned_unknown:
+                self._warned_unknown.add(can_id)
+                logger.warning("Standard decode failed for 0x%03X: %s", can_id, decode_error)
+            # Thử decode thủ công
+            decoded_signals = self.manual_decode(can_id, data, msg_def)
+        
+        # Ghép giá trị với SignalMeta dùng chung
+        metas = self._signal_meta[can_id]
+        signals = []
+        for signal_name, signal_value in decoded_signals.items():
+            meta = metas.get(signal_name)
+            if meta:
+                signals.append((meta, signal_value))
+        
+        return signals
+    
     def manual_decode(self, can_id: int, data: bytes, msg_def) -> Dict[str, Any]:
         """Decode thủ công nếu cantools không decode được"""
         decoded = {}
@@ -280,6 +509,7 @@ class VSSMapper:
     def __init__(self, mapping_config: str = None):
         self.mapping_config = mapping_config
         self.mappings = self.load_mappings()
+        self._compiled = self.compile_mappings()
         
     def load_mappings(self) -> Dict[str, Dict[str, Any]]:
         """Load VSS mapping configuration"""
@@ -331,57 +561,89 @@ class VSSMapper:
         # Thử load từ file config nếu có
         if self.mapping_config and Path(self.mapping_config).exists():
             try:
-                with open(self.mapping_config, 'r') as f:
-                    file_mappings = yaml.safe_load(f)
-                    if file_mappings:
-                        default_mappings.update(file_mappings)
-                        logger.info(f"Loaded VSS mappings from {self.mapping_config}")
+                file_mappings = _load_yaml_file(self.mapping_config)
+                if file_mappings:
+                    default_mappings.update(file_mappings)
+                    logger.info(f"Loaded VSS mappings from {self.mapping_config}")
             except Exception as e:
                 logger.warning(f"Cannot load mapping config: {e}")
         
         logger.info(f"Loaded {len(default_mappings)} VSS mappings")
         return default_mappings
     
+    def compile_mappings(self) -> Dict[int, List[tuple]]:
+        """Dựng bảng mapping theo CAN ID: (signal_name, vss_path, data_type, scale, offset, unit, description)"""
+        compiled = {}
+        for can_id, mapping in self.mappings.items():
+            table = []
+            for signal_name, vss_config in mapping.items():
+                conv = vss_config.get('conversion')
+                table.append((
+                    signal_name,
+                    vss_config['vss_path'],
+                    vss_config.get('data_type', 'unknown'),
+                    conv.get('scale', 1.0) if conv else 1.0,
+                    conv.get('offset', 0.0) if conv else 0.0,
+                    vss_config.get('unit', ''),
+                    vss_config.get('description', '')
+                ))
+            compiled[can_id] = table
+        return compiled
+    
+    def map_batch(self, can_id: int, columns: List[tuple]) -> List[tuple]:
+        """Map các cột signal (từ DBCManager.decode_batch) sang cột VSS:
+        list (vss_path, data_type, unit, description, values)"""
+        table = self._compiled.get(can_id)
+        if not table:
+            return []
+        
+        by_name = {column[0].name: column for column in columns}
+        mapped = []
+        for signal_name, vss_path, data_type, scale, offset, unit, description in table:
+            column = by_name.get(signal_name)
+            if column is None:
+                continue
+            meta, values = column
+            if scale != 1.0 or offset != 0.0:
+                values = values * scale + offset
+            mapped.append((vss_path, data_type, meta.unit or unit, description, values))
+        return mapped
+    
     def map_can_to_vss(self, can_msg: CANMessage) -> List[VSSSignal]:
         """Map CAN message sang VSS signals"""
         vss_signals = []
         can_id = can_msg.can_id
         
         # Kiểm tra nếu có mapping cho CAN ID này
-        if can_id not in self.mappings:
-            logger.debug(f"No VSS mapping for CAN ID 0x{can_id:03X}")
+        table = self._compiled.get(can_id)
+        if not table:
+            logger.debug("No VSS mapping for CAN ID 0x%03X", can_id)
             return vss_signals
         
-        mapping = self.mappings[can_id]
+        by_name = {signal[0].name: signal for signal in can_msg.signals}
+        timestamp = can_msg.timestamp
+        debug = logger.isEnabledFor(logging.DEBUG)
         
         # Map từng signal
-        for can_signal in can_msg.signals:
-            signal_name = can_signal.name
+        for signal_name, vss_path, data_type, scale, offset, unit, description in table:
+            can_signal = by_name.get(signal_name)
+            if can_signal is None:
+                continue
+            meta, value = can_signal
             
-            if signal_name in mapping:
-                vss_config = mapping[signal_name]
-                
-                # Áp dụng conversion nếu có
-                value = can_signal.value
-                if vss_config.get('conversion'):
-                    conv = vss_config['conversion']
-                    value = value * conv.get('scale', 1.0) + conv.get('offset', 0.0)
-                
-                # Tạo VSS signal
-                vss_signal = VSSSignal(
-                    path=vss_config['vss_path'],
-                    value=value,
-                    timestamp=can_msg.timestamp,
-                    data_type=vss_config.get('data_type', 'unknown'),
-                    min_value=can_signal.min_value,
-                    max_value=can_signal.max_value,
-                    unit=can_signal.unit or vss_config.get('unit', ''),
-                    description=vss_config.get('description', '')
-                )
-                
-                vss_signals.append(vss_signal)
-                
-                logger.debug(f"Mapped {signal_name} -> {vss_signal.path} = {value}")
+            # Áp dụng conversion nếu không phải identity
+            if scale != 1.0 or offset != 0.0:
+                value = value * scale + offset
+            
+            # Tạo VSS signal
+            vss_signal = VSSSignal(vss_path, value, timestamp, data_type,
+                                   meta.min_value, meta.max_value,
+                                   meta.unit or unit, description)
+            
+            vss_signals.append(vss_signal)
+            
+            if debug:
+                logger.debug("Mapped %s -> %s = %s", signal_name, vss_path, value)
         
         return vss_signals
 
@@ -391,14 +653,38 @@ class DatabaseManager:
     def __init__(self, db_path: str = "sdv_can_data.db"):
         self.db_path = db_path
         self.connection = None
+        
+        # Buffer các row chờ ghi, flush bằng executemany trong một transaction
+        # khi đủ flush_rows hoặc khi monitor_loop gọi flush() định kỳ
+        self.flush_rows = 500
+        self._msg_buf = []
+        self._vss_buf = []
+        self._lock = threading.Lock()
         self.setup_database()
     
     def setup_database(self):
         """Thiết lập database schema"""
         try:
-            self.connection = sqlite3.connect(self.db_path)
+            # flush() được gọi từ cả thread xử lý lẫn monitor thread (có lock bảo vệ)
+            self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
             cursor = self.connection.cursor()
             
+            # Tuning cho workload ghi nối tiếp: WAL + synchronous=NORMAL (không fsync mỗi
+            # commit), temp trong RAM, mmap 256 MB, page cache 64 MB, page 8 KB.
+            # page_size phải đặt trước khi tạo bảng (và trước khi chuyển sang WAL)
+            cursor.executescript(_SQLITE_PRAGMAS)
+            
+            # DB cũ tạo với page_size khác: rời WAL, VACUUM một lần để áp page_size mới
+            cursor.execute('PRAGMA page_size')
+            if cursor.fetchone()[0] != _SQLITE_PAGE_SIZE:
+                logger.info(f"Rebuilding {self.db_path} with page_size={_SQLITE_PAGE_SIZE}")
+                cursor.executescript(f'''
+                    PRAGMA journal_mode=DELETE;
+                    PRAGMA page_size={_SQLITE_PAGE_SIZE};
+                    VACUUM;
+                    PRAGMA journal_mode=WAL;
+                ''')
+            
             # Tạo bảng CAN messages
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS can_messages (
@@ -411,23 +697,26 @@ class DatabaseManager:
                     dlc INTEGER,
                     direction TEXT,
                     source TEXT,
+                    signals_json TEXT,
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
             
-            # Tạo bảng CAN signals
+            # DB cũ chưa có cột signals_json (signals từng nằm ở bảng can_signals riêng)
+            cursor.execute('PRAGMA table_info(can_messages)')
+            if 'signals_json' not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE can_messages ADD COLUMN signals_json TEXT')
+            
+            # View tách signals_json thành từng dòng signal cho truy vấn ad-hoc
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS can_signals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message_id INTEGER,
-                    signal_name TEXT,
-                    signal_value REAL,
-                    signal_unit TEXT,
-                    min_value REAL,
-                    max_value REAL,
-                    description TEXT,
-                    FOREIGN KEY (message_id) REFERENCES can_messages (id)
-                )
+                CREATE VIEW IF NOT EXISTS can_signals_view AS
+                SELECT m.id AS message_id,
+                       m.timestamp AS timestamp,
+                       m.can_id AS can_id,
+                       json_extract(s.value, '$[0]') AS signal_name,
+                       json_extract(s.value, '$[1]') AS signal_value,
+                       json_extract(s.value, '$[2]') AS signal_unit
+                FROM can_messages AS m, json_each(m.signals_json) AS s
             ''')
             
             # Tạo bảng VSS signals
@@ -453,23 +742,18 @@ class DatabaseManager:
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_vss_signals_timestamp ON vss_signals(timestamp)')
             
             self.connection.commit()
+
             logger.info(f"Database setup complete: {self.db_path}")
             
         except Exception as e:
             logger.error(f"Database setup failed: {e}")
             raise
     
-    def save_can_message(self, can_msg: CANMessage) -> Optional[int]:
-        """Lưu CAN message vào database"""
-        try:
-            cursor = self.connection.cursor()
-            
+    def save_can_message(self, can_msg: CANMessage):
+        """Đưa CAN message vào buffer ghi (id do SQLite gán khi flush)"""
+        with self._lock:
             # Lưu CAN message
-            cursor.execute('''
-                INSERT INTO can_messages 
-                (timestamp, can_id, can_id_hex, can_id_description, raw_data, dlc, direction, source)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
+            self._msg_buf.append((
                 can_msg.timestamp,
                 can_msg.can_id,
                 can_msg.can_id_hex,
@@ -477,65 +761,76 @@ class DatabaseManager:
                 can_msg.raw_data,
                 can_msg.dlc,
                 can_msg.direction,
-                can_msg.source
+                can_msg.source,
+                _signals_json(can_msg.signals)
             ))
             
-            message_id = cursor.lastrowid
-            
-            # Lưu các signals
-            for signal in can_msg.signals:
-                cursor.execute('''
-                    INSERT INTO can_signals 
-                    (message_id, signal_name, signal_value, signal_unit, min_value, max_value, description)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    message_id,
-                    signal.name,
-                    signal.value,
-                    signal.unit,
-                    signal.min_value,
-                    signal.max_value,
-                    signal.description
-                ))
-            
-            self.connection.commit()
-            return message_id
-            
-        except Exception as e:
-            logger.error(f"Failed to save CAN message: {e}")
-            self.connection.rollback()
-            return None
+            if len(self._msg_buf) >= self.flush_rows:
+                self._flush_locked()
     
     def save_vss_signals(self, vss_signals: List[VSSSignal], can_id: int, source_signal: str = ""):
-        """Lưu VSS signals vào database"""
-        try:
-            cursor = self.connection.cursor()
+        """Đưa VSS signals vào buffer ghi"""
+        with self._lock:
+            self._vss_buf.extend([
+                (s.timestamp, s.path, s.value, s.data_type, s.unit, s.description, can_id, source_signal)
+                for s in vss_signals
+            ])
             
-            for vss_signal in vss_signals:
-                cursor.execute('''
-                    INSERT INTO vss_signals 
-                    (timestamp, vss_path, vss_value, data_type, unit, description, source_can_id, source_signal_name)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    vss_signal.timestamp,
-                    vss_signal.path,
-                    vss_signal.value,
-                    vss_signal.data_type,
-                    vss_signal.unit,
-                    vss_signal.description,
-                    can_id,
-                    source_signal
-                ))
+            if len(self._vss_buf) >= self.flush_rows:
+                self._flush_locked()
+    
+    def save_can_batch(self, timestamp: float, can_id: int, can_id_hex: str, description: str,
+                       raw_rows: List[bytes], columns: List[tuple], source: str = "CAN_Bus"):
+        """Đưa một lô message cùng CAN ID (dạng cột từ decode_batch) vào buffer ghi"""
+        with self._lock:
+            metas = [meta for meta, _ in columns]
+            # Không có cột signal (CAN ID không có VSS mapping): signals_json là "[]"
+            rows = zip(*[values.tolist() for _, values in columns]) if columns else [()] * len(raw_rows)
+            self._msg_buf.extend(
+                (timestamp, can_id, can_id_hex, description, raw, len(raw), "RX", source,
+                 _signals_json(zip(metas, row)))
+                for raw, row in zip(raw_rows, rows)
+            )
             
-            self.connection.commit()
+            if len(self._msg_buf) >= self.flush_rows:
+                self._flush_locked()
+    
+    def save_vss_batch(self, timestamp: float, can_id: int, source_signal: str, mapped: List[tuple]):
+        """Đưa các cột VSS (từ VSSMapper.map_batch) vào buffer ghi"""
+        with self._lock:
+            for vss_path, data_type, unit, description, values in mapped:
+                self._vss_buf.extend(
+                    (timestamp, vss_path, value, data_type, unit, description, can_id, source_signal)
+                    for value in values.tolist()
+                )
             
+            if len(self._vss_buf) >= self.flush_rows:
+                self._flush_locked()
+    
+    def flush(self):
+        """Ghi toàn bộ buffer xuống database"""
+        with self._lock:
+            self._flush_locked()
+    
+    def _flush_locked(self):
+        """Ghi buffer bằng executemany trong một transaction (gọi khi đang giữ lock)"""
+        if not (self._msg_buf or self._vss_buf):
+            return
+        
+        messages, vss = self._msg_buf, self._vss_buf
+        self._msg_buf, self._vss_buf = [], []
+        try:
+            with self.connection:  # Một BEGIN/COMMIT cho cả lô, lỗi thì rollback
+                cursor = self.connection.cursor()
+                cursor.executemany(_INSERT_CAN, messages)
+                cursor.executemany(_INSERT_VSS, vss)
         except Exception as e:
-            logger.error(f"Failed to save VSS signals: {e}")
-            self.connection.rollback()
+            logger.error(f"Failed to flush {len(messages)} CAN messages, {len(vss)} VSS signals: {e}")
     
     def get_message_count(self) -> int:
         """Lấy số lượng messages trong database"""
         try:
+            self.flush()
             cursor = self.connection.cursor()
             cursor.execute('SELECT COUNT(*) FROM can_messages')
             return cursor.fetchone()[0]
@@ -545,26 +840,30 @@ class DatabaseManager:
     def close(self):
         """Đóng database connection"""
         if self.connection:
-            self.connection.close()
+            with self._lock:
+                self._flush_locked()
+                self.connection.close()
 
 class ZonalController:
     """Main Zonal Controller class"""
     
     def __init__(self, dbc_path: str = "lights.dbc", zmq_host: str = "localhost", zmq_port: int = 5555,
-                 can_interface: str = "vcan0", vss_mapping: str = None):
+                 can_interface: str = "vcan0", vss_mapping: str = None, save_unmapped: bool = False):
         self.dbc_path = dbc_path
         self.zmq_host = zmq_host
         self.zmq_port = zmq_port
         self.can_interface = can_interface
         
         # Initialize components
-        self.dbc_manager = DBCManager(dbc_path)
         self.vss_mapper = VSSMapper(vss_mapping)
+        self.dbc_manager = DBCManager(dbc_path, mapped_ids=self.vss_mapper.mappings,
+                                      save_unmapped=save_unmapped)
         self.db_manager = DatabaseManager()
         
         # ZMQ setup
-        self.context = zmq.Context()
+        self.context = zmq.Context.instance()  # Context dùng chung trong process
         self.subscriber = self.context.socket(zmq.SUB)
+        self._decoder = msgspec.msgpack.Decoder()
         
         # CAN bus setup
         self.can_bus = None
@@ -573,6 +872,20 @@ class ZonalController:
         # State
         self.running = False
         
+        # Hàng chờ message từ ZMQ: đủ batch_size thì decode cả lô bằng numpy,
+        # quá batch_timeout mà chưa đủ thì xử lý từng message
+        self.batch_size = 32
+        self.batch_timeout = 0.01
+        self._pending = []
+        self._pending_since = 0.0
+        self._now = time.time()  # Timestamp dùng chung, cập nhật mỗi lượt poll trong run()
+        
+        # Ghi SQLite ở writer thread riêng: luồng nhận/decode chỉ put vào queue
+        self.write_batch = 500
+        self.write_interval = 0.05
+        self._wq = queue.SimpleQueue()
+        self._writer_thread = threading.Thread(target=self._writer, daemon=True)
+        
         # Statistics
         self.stats = {
             'messages_received': 0,
@@ -581,6 +894,13 @@ class ZonalController:
             'errors': 0,
             'start_time': time.time()
         }
+        # Bộ đếm hot path là attribute int, chỉ chép vào self.stats khi cần hiển thị
+        self._rx = 0
+        self._decoded = 0
+        self._vss_mapped = 0
+        self._errors = 0
+        self.log_interval = 10  # Log chi tiết mỗi 10 message decode được
+        self._log_countdown = self.log_interval
         
     def setup_can_bus(self):
         """Thiết lập CAN bus connection"""
@@ -599,8 +919,10 @@ class ZonalController:
         """Kết nối đến ZMQ publisher"""
         try:
             zmq_address = f"tcp://{self.zmq_host}:{self.zmq_port}"
+            self.subscriber.setsockopt(zmq.RCVHWM, 100000)
+            self.subscriber.setsockopt(zmq.RCVBUF, 4 << 20)
             self.subscriber.connect(zmq_address)
-            self.subscriber.setsockopt_string(zmq.SUBSCRIBE, "")  # Subscribe to all
+            self.subscriber.setsockopt_string(zmq.SUBSCRIBE, "")  # Subscribe to all (mọi CAN ID đều lưu DB)
             logger.info(f"Connected to ZMQ publisher at {zmq_address}")
             return True
         except Exception as e:
@@ -610,7 +932,7 @@ class ZonalController:
     def process_zmq_message(self, data: Dict[str, Any]):
         """Xử lý message từ ZMQ"""
         try:
-            self.stats['messages_received'] += 1
+            self._rx += 1
             
             # Extract CAN data
             can_id = data.get('can_id')
@@ -620,65 +942,200 @@ class ZonalController:
                 logger.warning("Invalid message format")
                 return
             
-            # Chuyển đổi data thành bytes
-            if isinstance(can_data, list):
+            # Chuyển đổi data thành bytes (msgpack bin, hoặc list int)
+            if isinstance(can_data, (bytes, list)):
                 can_data_bytes = bytes(can_data)
             else:
-                logger.error(f"Invalid can_data format: {type(can_data)}")
+                logger.error("Invalid can_data format: %s", type(can_data))
                 return
             
             # Decode sử dụng DBC
-            can_msg = self.dbc_manager.decode_message(can_id, can_data_bytes)
+            can_msg = self.dbc_manager.decode_message(can_id, can_data_bytes, ts=self._now)
             if not can_msg:
-                logger.debug(f"Could not decode CAN ID 0x{can_id:03X}")
+                logger.debug("Could not decode CAN ID 0x%03X", can_id)
                 return
             
-            self.stats['messages_decoded'] += 1
-            
-            # Lưu CAN message vào database
-            message_id = self.db_manager.save_can_message(can_msg)
+            self._decoded += 1
+            self._log_countdown -= 1
             
             # Map sang VSS
             vss_signals = self.vss_mapper.map_can_to_vss(can_msg)
             
+            # Lưu CAN message và VSS signals vào database (qua writer thread)
+            self._wq.put(('msg', can_msg, vss_signals, self.dbc_manager.joined_signal_names.get(can_id, "")))
+            
             if vss_signals:
-                self.stats['vss_signals_mapped'] += len(vss_signals)
+                self._vss_mapped += len(vss_signals)
                 
-                # Lưu VSS signals vào database
-                self.db_manager.save_vss_signals(
-                    vss_signals, 
-                    can_id, 
-                    ", ".join([s.name for s in can_msg.signals])
-                )
-                
-                # Hiển thị thông tin (mỗi 10 messages)
-                if self.stats['messages_decoded'] % 10 == 0:
+                # Hiển thị thông tin (mỗi log_interval messages)
+                if self._log_countdown <= 0:
+                    self._log_countdown = self.log_interval
                     self.log_processing_info(can_msg, vss_signals)
             
         except Exception as e:
-            logger.error(f"Error processing ZMQ message: {e}")
-            self.stats['errors'] += 1
+            logger.error("Error processing ZMQ message: %s", e)
+            self._errors += 1
+    
+    def queue_zmq_message(self, data: Dict[str, Any]):
+        """Đưa message từ ZMQ vào hàng chờ để decode theo lô"""
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending.append(data)
+        if len(self._pending) >= self.batch_size:
+            self.flush_pending()
+    
+    def flush_pending(self):
+        """Xử lý hàng chờ: đủ lô thì decode vector hoá, ít hơn thì từng message"""
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = []
+        
+        if np is None or len(pending) < self.batch_size:
+            for data in pending:
+                self.process_zmq_message(data)
+            return
+        
+        try:
+            self.process_zmq_batch(pending)
+        except Exception as e:
+            logger.error(f"Error processing ZMQ batch: {e}")
+            self._errors += 1
+    
+    def process_zmq_batch(self, messages: List[Dict[str, Any]]):
+        """Decode một lô message ZMQ bằng numpy rồi ghi dạng cột"""
+        valid = []
+        rows = []
+        ids = []
+        for data in messages:
+            can_id = data.get('can_id')
+            can_data = data.get('can_data')
+            if isinstance(can_id, int) and isinstance(can_data, (bytes, list)) and len(can_data) <= 8:
+                valid.append(data)
+                ids.append(can_id)
+                rows.append(bytes(can_data).ljust(8, b'\0'))
+            else:
+                self.process_zmq_message(data)  # Để đường từng message log/đếm lỗi
+        
+        if not ids:
+            return
+        
+        groups, leftover = self.dbc_manager.decode_batch(
+            np.array(ids, dtype=np.int32),
+            np.frombuffer(b''.join(rows), dtype=np.uint8).reshape(-1, 8)
+        )
+        
+        timestamp = self._now
+        for can_id, (index, columns) in groups.items():
+            count = len(index)
+            self._rx += count
+            self._decoded += count
+            
+            mapped = self.vss_mapper.map_batch(can_id, columns)
+            if mapped:
+                self._vss_mapped += count * len(mapped)
+                
+                # Hiển thị thông tin (mỗi log_interval messages như đường từng message):
+                # decode lại đúng các dòng mà countdown chạm 0 trong lô
+                if self._log_countdown <= count:
+                    positions = range(max(self._log_countdown, 1) - 1, count, self.log_interval)
+                    for k in positions:
+                        can_msg = self.dbc_manager.decode_message(can_id, rows[index[k]], ts=timestamp)
+                        if can_msg:
+                            self.log_processing_info(can_msg, self.vss_mapper.map_can_to_vss(can_msg))
+                    self._log_countdown = self.log_interval - (count - 1 - positions[-1])
+                else:
+                    self._log_countdown -= count
+            else:
+                self._log_countdown -= count
+            
+            self._wq.put(('batch', timestamp, can_id, self.dbc_manager.can_id_hex(can_id),
+                          self.dbc_manager.message_cache[can_id].name,
+                          [rows[i] for i in index.tolist()], columns, mapped,
+                          self.dbc_manager.joined_signal_names.get(can_id, "")))
+        
+        # Frame không có codec: decode từng message (cantools)
+        for i in leftover:
+            self.process_zmq_message(valid[i])
+    
+    def drain_zmq(self):
+        """Đọc hết các batch đang chờ trên ZMQ (không block) và đưa vào hàng chờ decode"""
+        while True:
+            try:
+                frames = self.subscriber.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            
+            for frame in frames[1:]:  # Frame đầu là topic (CAN ID 2 byte)
+                try:
+                    data = self._decoder.decode(frame.buffer)
+                except msgspec.DecodeError as e:
+                    logger.warning("Invalid ZMQ message: %s", e)
+                    self._errors += 1
+                    continue
+                self.queue_zmq_message(data)
     
     def process_can_message(self, can_msg: can.Message):
         """Xử lý CAN message trực tiếp từ bus (nếu cần)"""
         try:
             # Decode sử dụng DBC
-            decoded_msg = self.dbc_manager.decode_message(can_msg.arbitration_id, can_msg.data)
+            decoded_msg = self.dbc_manager.decode_message(can_msg.arbitration_id, can_msg.data, ts=self._now)
             if decoded_msg:
                 # Cập nhật source
                 decoded_msg.source = "CAN_Bus_Direct"
                 decoded_msg.direction = "RX"
                 
-                # Lưu vào database
-                self.db_manager.save_can_message(decoded_msg)
-                
-                # Map sang VSS
+                # Map sang VSS rồi lưu vào database (qua writer thread)
                 vss_signals = self.vss_mapper.map_can_to_vss(decoded_msg)
-                if vss_signals:
-                    self.db_manager.save_vss_signals(vss_signals, can_msg.arbitration_id)
+                self._wq.put(('msg', decoded_msg, vss_signals, ""))
                     
         except Exception as e:
-            logger.error(f"Error processing CAN message: {e}")
+            logger.error("Error processing CAN message: %s", e)
+    
+    def _writer(self):
+        """Writer thread: gom item từ queue (tối đa write_batch hoặc write_interval) rồi commit một lần"""
+        wq = self._wq
+        stopping = False
+        while not stopping:
+            item = wq.get()
+            if item is None:
+                break
+            
+            batch = [item]
+            deadline = time.monotonic() + self.write_interval
+            while len(batch) < self.write_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = wq.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:  # Sentinel từ stop(): ghi nốt lô này rồi thoát
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            try:
+                self.write_items(batch)
+            except Exception as e:
+                logger.error("Database writer error: %s", e)
+    
+    def write_items(self, items: List[tuple]):
+        """Ghi các item từ writer queue vào database trong một transaction"""
+        db = self.db_manager
+        for item in items:
+            if item[0] == 'msg':
+                _, can_msg, vss_signals, source_signal = item
+                db.save_can_message(can_msg)
+                if vss_signals:
+                    db.save_vss_signals(vss_signals, can_msg.can_id, source_signal)
+            else:
+                _, timestamp, can_id, can_id_hex, description, raw_rows, columns, mapped, source_signal = item
+                db.save_can_batch(timestamp, can_id, can_id_hex, description, raw_rows, columns)
+                if mapped:
+                    db.save_vss_batch(timestamp, can_id, source_signal, mapped)
+        db.flush()
     
     def log_processing_info(self, can_msg: CANMessage, vss_signals: List[VSSSignal]):
         """Log thông tin xử lý"""
@@ -688,12 +1145,12 @@ class ZonalController:
             
             # Tìm headLamp signal
             headlamp_value = None
-            for signal in can_msg.signals:
-                if signal.name == 'headLamp':
-                    headlamp_value = signal.value
-                    logger.info(f"  {signal.name}: {'ON' if signal.value else 'OFF'}")
+            for meta, value in can_msg.signals:
+                if meta.name == 'headLamp':
+                    headlamp_value = value
+                    logger.info(f"  {meta.name}: {'ON' if value else 'OFF'}")
                 # else:
-                #     logger.info(f"  {signal.name}: {signal.value} {signal.unit}")
+                #     logger.info(f"  {meta.name}: {value} {meta.unit}")
             
             for vss_signal in vss_signals:
                 if 'IsHighBeamOn' in vss_signal.path:
@@ -707,9 +1164,15 @@ class ZonalController:
     
     def monitor_loop(self):
         """Vòng lặp giám sát và hiển thị statistics"""
+        next_stats = time.monotonic() + 30
         while self.running:
-            time.sleep(30)  # Cập nhật mỗi 30 giây
+            time.sleep(1)
+            
+            if time.monotonic() < next_stats:  # Cập nhật statistics mỗi 30 giây
+                continue
+            next_stats += 30
             
+            self.sync_stats()
             elapsed = time.time() - self.stats['start_time']
             if elapsed > 0:
                 msg_rate = self.stats['messages_received'] / elapsed
@@ -739,57 +1202,88 @@ class ZonalController:
         
         self.running = True
         
-        # Start monitoring thread
+        # Start database writer và monitoring thread
+        self._writer_thread.start()
         monitor_thread = threading.Thread(target=self.monitor_loop, daemon=True)
         monitor_thread.start()
         
-        # Poller cho cả ZMQ và CAN
-        # poller = zmq.Poller()
-        # poller.register(self.subscriber, zmq.POLLIN)
+        # Một selector chờ cả FD của ZMQ và socket CAN: chỉ thức dậy khi có dữ liệu
+        selector = selectors.DefaultSelector()
+        selector.register(self.subscriber.get(zmq.FD), selectors.EVENT_READ, 'zmq')
+        can_selectable = False
+        if self.can_bus:
+            try:
+                selector.register(self.can_bus.fileno(), selectors.EVENT_READ, 'can')
+                can_selectable = True
+            except (NotImplementedError, AttributeError, ValueError, OSError) as e:
+                logger.warning(f"CAN bus has no selectable fd ({e}), polling it every 10 ms")
         
         logger.info("Zonal Controller ready. Processing messages...")
         
+        backoff = 0.01
         try:
             while self.running:
                 try:
-                    # Poll với timeout
-                    # socks = dict(poller.poll(timeout=1000))  # 1 second timeout
+                    # Timeout: hạn flush lô ZMQ đang chờ, poll CAN nếu không select được, hoặc 1s
+                    timeout = 1.0
+                    if self._pending:
+                        timeout = max(self._pending_since + self.batch_timeout - time.monotonic(), 0.0)
+                    if self.can_bus and not can_selectable:
+                        timeout = min(timeout, 0.01)
+                    events = selector.select(timeout=timeout)
+                    self._now = time.time()  # Một lần gọi time() cho mọi message của lượt poll
                     
-                    # if self.subscriber in socks:
-                    #     # Nhận message từ ZMQ
-                    #     message = self.subscriber.recv_json()
-                    #     self.process_zmq_message(message)
+                    # FD của ZMQ là edge-triggered: luôn đọc đến khi hết (zmq.Again)
+                    self.drain_zmq()
                     
                     # Cũng có thể đọc trực tiếp từ CAN bus nếu cần
-                    if self.can_bus:
-                        can_msg = self.can_bus.recv(timeout=0.1)  # Non-blocking
-                        if can_msg:
+                    if self.can_bus and (events or not can_selectable):
+                        can_msg = self.can_bus.recv(timeout=0)  # Non-blocking
+                        while can_msg is not None:
                             self.process_can_message(can_msg)
+                            can_msg = self.can_bus.recv(timeout=0)
+                    
+                    # Lô ZMQ chưa đủ batch_size nhưng đã chờ quá batch_timeout
+                    if self._pending and time.monotonic() - self._pending_since >= self.batch_timeout:
+                        self.flush_pending()
+                    backoff = 0.01
                     
                 except zmq.ZMQError as e:
                     logger.error(f"ZMQ error: {e}")
-                    time.sleep(1)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 1.0)
                 except Exception as e:
                     logger.error(f"Processing error: {e}")
-                    time.sleep(1)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 1.0)
                     
         except KeyboardInterrupt:
             logger.info("Zonal Controller stopped by user")
         except Exception as e:
             logger.error(f"Zonal Controller error: {e}")
         finally:
+            selector.close()
             self.stop()
     
     def stop(self):
         """Dừng controller"""
         self.running = False
         
+        # Xử lý nốt các message còn trong hàng chờ, đợi writer ghi xong
+        if hasattr(self, '_pending') and self._pending:
+            self.flush_pending()
+        
+        if hasattr(self, '_wq'):
+            self._wq.put(None)
+            if self._writer_thread.is_alive():
+                self._writer_thread.join(timeout=5)
+            else:
+                self._writer()  # Writer chưa chạy (không qua run()): ghi đồng bộ
+        
         # Cleanup
+        # Context dùng chung (Context.instance()) không term ở đây, chỉ đóng socket
         if hasattr(self, 'subscriber') and self.subscriber:
-            self.subscriber.close()
-        
-        if hasattr(self, 'context') and self.context:
-            self.context.term()
+            self.subscriber.close(linger=0)
         
         if hasattr(self, 'can_bus') and self.can_bus:
             self.can_bus.shutdown()
@@ -800,8 +1294,16 @@ class ZonalController:
         # Print final statistics
         self.print_statistics()
     
+    def sync_stats(self):
+        """Chép các bộ đếm hot path vào self.stats"""
+        self.stats['messages_received'] = self._rx
+        self.stats['messages_decoded'] = self._decoded
+        self.stats['vss_signals_mapped'] = self._vss_mapped
+        self.stats['errors'] = self._errors
+    
     def print_statistics(self):
         """In thống kê cuối cùng"""
+        self.sync_stats()
         elapsed = time.time() - self.stats['start_time']
         
         logger.info("\n" + "="*60)
@@ -818,8 +1320,14 @@ class ZonalController:
         
         logger.info("="*60)
 
+# Đường dẫn VSS mapping mẫu sau lần create_sample_files đầu tiên trong process
+_sample_mapping_path: Optional[str] = None
+
 def create_sample_files():
     """Tạo các file cấu hình mẫu nếu chưa có"""
+    global _sample_mapping_path
+    if _sample_mapping_path is not None:
+        return _sample_mapping_path
     
     # Tạo thư mục config nếu chưa có
     config_dir = Path("config")
@@ -876,15 +1384,15 @@ def create_sample_files():
     
     vss_mapping_path = config_dir / "vss_mapping.yaml"
     if not vss_mapping_path.exists():
-        with open(vss_mapping_path, 'w') as f:
-            f.write(vss_mapping_content)
+        vss_mapping_path.write_text(vss_mapping_content)
         logger.info(f"Created sample VSS mapping file: {vss_mapping_path}")
     
     # Tạo thư mục logs nếu chưa có
     logs_dir = Path("logs")
     logs_dir.mkdir(exist_ok=True)
     
-    return str(vss_mapping_path)
+    _sample_mapping_path = str(vss_mapping_path)
+    return _sample_mapping_path
 
 def main():
     """Hàm chính"""
@@ -901,6 +1409,8 @@ def main():
                        help='CAN interface name')
     parser.add_argument('--vss-mapping', type=str, default=None,
                        help='Path to VSS mapping YAML file')
+    parser.add_argument('--save-unmapped-signals', action='store_true',
+                       help='Decode and store signals of CAN IDs without VSS mapping')
     parser.add_argument('--verbose', action='store_true',
                        help='Enable verbose logging')
     
@@ -921,7 +1431,8 @@ def main():
             zmq_host=args.zmq_host,
             zmq_port=args.zmq_port,
             can_interface=args.can_interface,
-            vss_mapping=args.vss_mapping
+            vss_mapping=args.vss_mapping,
+            save_unmapped=args.save_unmapped_signals
         )
         
         controller.run()
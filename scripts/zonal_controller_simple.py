@@ -4,14 +4,23 @@ Zonal Controller Simple Version: Nhận CAN messages và map sang VSS
 """
 
 import zmq
-import json
 import time
 import logging
-from typing import Dict, Any, List
+import msgspec
+from typing import Dict, Any, List, Union
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("ZonalControllerSimple")
 
+# Byte 0 của 0x100 -> (headLamp, tailLamp, brakeLamp, indicatorLeft, indicatorRight)
+_BYTE0_LUT = tuple(((v & 1) != 0, (v & 2) != 0, (v & 4) != 0, (v & 8) != 0, (v & 16) != 0)
+                   for v in range(256))
+
+class CANFrame(msgspec.Struct):
+    """CAN message nhận từ ZMQ (các field khác trong message bị bỏ qua khi decode)"""
+    can_id: int
+    can_data: Union[bytes, List[int]]
+
 class SimpleZonalController:
     """Zonal Controller đơn giản"""
     
@@ -19,9 +28,14 @@ class SimpleZonalController:
         self.zmq_host = zmq_host
         self.zmq_port = zmq_port
         
-        # ZMQ setup
-        self.context = zmq.Context()
+        # ZMQ setup (None trước để stop() an toàn nếu khởi tạo lỗi giữa chừng)
+        self.context = None
+        self.subscriber = None
+        self.context = zmq.Context.instance()  # Context dùng chung trong process
         self.subscriber = self.context.socket(zmq.SUB)
+        self._poller = zmq.Poller()
+        self._poller.register(self.subscriber, zmq.POLLIN)
+        self._decoder = msgspec.msgpack.Decoder(CANFrame)
         
         # VSS mapping cho CAN ID 0x100
         self.vss_mapping = {
@@ -34,12 +48,39 @@ class SimpleZonalController:
             }
         }
         
+        # Dict kết quả decode 0x100 dùng lại mỗi message (payload đủ 5 byte có đủ mọi key)
+        self._decoded_buf = {
+            'headLamp': False,
+            'tailLamp': False,
+            'brakeLamp': False,
+            'indicatorLeft': False,
+            'indicatorRight': False,
+            'lightLevel': 0,
+            'vehicleSpeed': 0,
+            'ambient': 0,
+        }
+        
+        # Template VSS theo CAN ID: (signal, vss_path, type) theo thứ tự xuất ra
+        self._layout = {
+            0x100: (
+                ('headLamp', 'Vehicle.Body.Lights.IsHighBeamOn', 'boolean'),
+                ('tailLamp', 'Vehicle.Body.Lights.IsTailLightOn', 'boolean'),
+                ('lightLevel', 'Vehicle.Body.Lights.AmbientLight', 'uint8'),
+                ('vehicleSpeed', 'Vehicle.Speed', 'uint8'),
+            )
+        }
+        
         # Statistics
         self.stats = {
             'messages_received': 0,
             'errors': 0,
             'start_time': time.time()
         }
+        # Bộ đếm hot path là attribute int, chỉ chép vào self.stats khi cần hiển thị
+        self._rx = 0
+        self._errors = 0
+        self.log_interval = 10  # Log chi tiết mỗi 10 message
+        self._log_countdown = self.log_interval
         
         self.running = False
     
@@ -47,113 +88,99 @@ class SimpleZonalController:
         """Kết nối đến ZMQ publisher"""
         try:
             zmq_address = f"tcp://{self.zmq_host}:{self.zmq_port}"
+            self.subscriber.setsockopt(zmq.RCVHWM, 100000)
+            self.subscriber.setsockopt(zmq.RCVBUF, 4 << 20)
             self.subscriber.connect(zmq_address)
-            self.subscriber.setsockopt_string(zmq.SUBSCRIBE, "")
+            # Chỉ nhận các CAN ID có decode (topic 2 byte big-endian), ZMQ lọc phần còn lại
+            for can_id in self._layout:
+                self.subscriber.setsockopt(zmq.SUBSCRIBE, can_id.to_bytes(2, 'big'))
             logger.info(f"Connected to ZMQ publisher at {zmq_address}")
             return True
         except Exception as e:
             logger.error(f"Cannot connect to ZMQ: {e}")
             return False
     
-    def decode_can_data(self, can_id: int, can_data: List[int]) -> Dict[str, Any]:
-        """Decode CAN data đơn giản"""
-        decoded = {}
-        
-        if can_id == 0x100:
-            # Decode byte 0 (boolean signals)
-            if len(can_data) > 0:
-                byte0 = can_data[0]
-                decoded['headLamp'] = bool(byte0 & 0x01)
-                decoded['tailLamp'] = bool(byte0 & 0x02)
-                decoded['brakeLamp'] = bool(byte0 & 0x04)
-                decoded['indicatorLeft'] = bool(byte0 & 0x08)
-                decoded['indicatorRight'] = bool(byte0 & 0x10)
-            
-            # Decode byte 1 (light level)
-            if len(can_data) > 1:
-                decoded['lightLevel'] = can_data[1]
-            
-            # Decode byte 2 (vehicle speed)
-            if len(can_data) > 2:
-                decoded['vehicleSpeed'] = can_data[2]
-            
-            # Decode ambient (bytes 3-4)
-            if len(can_data) > 4:
-                ambient = (can_data[3] << 8) | can_data[4]
-                decoded['ambient'] = ambient
+    def decode_can_data(self, can_id: int, can_data: bytes) -> Dict[str, Any]:
+        """Decode CAN data đơn giản.
+        
+        Frame 0x100 đủ 5 byte được ghi đè vào một dict dùng chung: kết quả chỉ
+        hợp lệ đến lần gọi tiếp theo (process_message dùng xong ngay).
+        """
+        if can_id != 0x100 or not can_data:
+            return {}
+        
+        # Chuyển payload (msgpack bin, hoặc list int) về bytes một lần
+        buf = can_data if isinstance(can_data, (bytes, bytearray)) else bytes(can_data)
+        n = len(buf)
+        decoded = self._decoded_buf if n > 4 else {}
+        
+        # Decode byte 0 (boolean signals)
+        head, tail, brake, left, right = _BYTE0_LUT[buf[0]]
+        decoded['headLamp'] = head
+        decoded['tailLamp'] = tail
+        decoded['brakeLamp'] = brake
+        decoded['indicatorLeft'] = left
+        decoded['indicatorRight'] = right
+        
+        # Decode byte 1 (light level)
+        if n > 1:
+            decoded['lightLevel'] = buf[1]
+        
+        # Decode byte 2 (vehicle speed)
+        if n > 2:
+            decoded['vehicleSpeed'] = buf[2]
+        
+        # Decode ambient (bytes 3-4)
+        if n > 4:
+            decoded['ambient'] = (buf[3] << 8) | buf[4]
         
         return decoded
     
-    def map_to_vss(self, can_id: int, decoded_data: Dict[str, Any]) -> List[Dict[str, Any]]:
-        """Map decoded data sang VSS"""
-        vss_signals = []
-        
-        if can_id == 0x100:
-            # Map từng signal
-            if 'headLamp' in decoded_data:
-                vss_signals.append({
-                    'path': 'Vehicle.Body.Lights.IsHighBeamOn',
-                    'value': decoded_data['headLamp'],
-                    'type': 'boolean',
-                    'timestamp': time.time()
-                })
-            
-            if 'tailLamp' in decoded_data:
-                vss_signals.append({
-                    'path': 'Vehicle.Body.Lights.IsTailLightOn',
-                    'value': decoded_data['tailLamp'],
-                    'type': 'boolean',
-                    'timestamp': time.time()
-                })
-            
-            if 'lightLevel' in decoded_data:
-                vss_signals.append({
-                    'path': 'Vehicle.Body.Lights.AmbientLight',
-                    'value': decoded_data['lightLevel'],
-                    'type': 'uint8',
-                    'timestamp': time.time()
-                })
-            
-            if 'vehicleSpeed' in decoded_data:
-                vss_signals.append({
-                    'path': 'Vehicle.Speed',
-                    'value': decoded_data['vehicleSpeed'],
-                    'type': 'uint8',
-                    'timestamp': time.time()
-                })
-        
-        return vss_signals
+    def map_to_vss(self, can_id: int, decoded_data: Dict[str, Any], ts: float = None) -> List[Dict[str, Any]]:
+        """Map decoded data sang VSS (ts: thời điểm nhận message, mặc định là lúc gọi)"""
+        layout = self._layout.get(can_id)
+        if not layout:
+            return []
+        
+        if ts is None:
+            ts = time.time()
+        return [{'path': path, 'value': decoded_data[name], 'type': data_type, 'timestamp': ts}
+                for name, path, data_type in layout if name in decoded_data]
     
-    def process_message(self, data: Dict[str, Any]):
+    def process_message(self, data: CANFrame):
         """Xử lý một message"""
         try:
-            self.stats['messages_received'] += 1
+            self._rx += 1
+            ts = time.time()  # Đọc đồng hồ một lần cho cả message
             
-            can_id = data.get('can_id')
-            can_data = data.get('can_data', [])
+            can_id = data.can_id
+            can_data = data.can_data
             
-            if not can_id or not can_data:
+            # can_id luôn có (CANFrame bắt buộc field này khi decode), kể cả ID 0
+            if not can_data:
                 return
             
             # Decode CAN data
             decoded = self.decode_can_data(can_id, can_data)
             
             # Map sang VSS
-            vss_signals = self.map_to_vss(can_id, decoded)
+            vss_signals = self.map_to_vss(can_id, decoded, ts)
             
-            # Log thông tin
-            if self.stats['messages_received'] % 10 == 0:
-                headlamp_status = "ON" if decoded.get('headLamp', False) else "OFF"
-                light_level = decoded.get('lightLevel', 0)
-                
-                logger.info(f"CAN 0x{can_id:03X}: Headlamp={headlamp_status}, Light={light_level}%")
-                
-                for vss_signal in vss_signals:
-                    logger.info(f"  → {vss_signal['path']}: {vss_signal['value']}")
+            # Log thông tin (bỏ qua hẳn khi logger không bật INFO)
+            self._log_countdown -= 1
+            if self._log_countdown <= 0:
+                self._log_countdown = self.log_interval
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("CAN 0x%03X: Headlamp=%s, Light=%s%%", can_id,
+                                "ON" if decoded.get('headLamp', False) else "OFF",
+                                decoded.get('lightLevel', 0))
+                    
+                    for vss_signal in vss_signals:
+                        logger.info("  → %s: %s", vss_signal['path'], vss_signal['value'])
             
         except Exception as e:
             logger.error(f"Error processing message: {e}")
-            self.stats['errors'] += 1
+            self._errors += 1
     
     def run(self):
         """Chạy controller"""
@@ -166,12 +193,34 @@ class SimpleZonalController:
         self.running = True
         logger.info("✅ Ready. Waiting for CAN messages...")
         
+        # Bind sẵn vào biến local cho vòng lặp nóng
+        poll = self._poller.poll
+        recv_multipart = self.subscriber.recv_multipart
+        decode = self._decoder.decode
+        process_message = self.process_message
+        
         try:
             while self.running:
                 try:
-                    # Nhận message từ ZMQ
-                    message = self.subscriber.recv_json()
-                    self.process_message(message)
+                    if not poll(100):
+                        continue
+                    
+                    # Đọc hết các batch đang chờ trong một lượt: frame đầu là topic CAN ID,
+                    # mỗi frame sau là một CAN message msgpack, decode thẳng vào CANFrame
+                    # (thiếu field thì DecodeError)
+                    while True:
+                        try:
+                            frames = recv_multipart(zmq.NOBLOCK, copy=False)
+                        except zmq.Again:
+                            break
+                        for frame in frames[1:]:
+                            try:
+                                message = decode(frame.buffer)
+                            except msgspec.DecodeError as e:
+                                logger.error(f"Invalid message: {e}")
+                                self._errors += 1
+                                continue
+                            process_message(message)
                     
                 except zmq.ZMQError as e:
                     logger.error(f"ZMQ error: {e}")
@@ -185,17 +234,25 @@ class SimpleZonalController:
         finally:
             self.stop()
     
+    def sync_stats(self):
+        """Chép các bộ đếm hot path vào self.stats"""
+        self.stats['messages_received'] = self._rx
+        self.stats['errors'] = self._errors
+    
     def stop(self):
         """Dừng controller"""
         self.running = False
         
-        if hasattr(self, 'subscriber'):
-            self.subscriber.close()
+        if self.subscriber is not None:
+            self.subscriber.close(linger=0)
+            self.subscriber = None
         
-        if hasattr(self, 'context'):
-            self.context.term()
+        # Context dùng chung (Context.instance()) không term ở đây: socket khác
+        # trong process có thể vẫn đang mở, term() sẽ block
+        self.context = None
         
         # Print statistics
+        self.sync_stats()
         elapsed = time.time() - self.stats['start_time']
         logger.info(f"\n📊 Statistics: {self.stats['messages_received']} messages, "
                   f"{self.stats['errors']} errors, "